@@ -0,0 +1,146 @@
+# Batch runner
+# Runs many roms headless across a process pool, one emulator at a time per worker, and collects
+# the final frame, a ram snapshot and the timing of each job.
+# Every worker loads the opcode tables once and keeps the rom bytes it has read, later jobs reuse them.
+#
+# A job is a rom, an optional input script and a number of frames. An input script has one line per change:
+#   <frame> [button ...]
+# holding the listed buttons (right, left, up, down, a, b, select, start) from that frame on, e.g.
+#   60 start
+#   62
+#   100 a right
+# A jobs file is a json list of {"rom": path, "script": path, "frames": count} objects.
+import argparse
+import hashlib
+import json
+import os
+import sys
+import time
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+from cartridge import read_cartridge_metadata
+from cpu import CPU
+from joypad import BUTTONS
+from opcodes import getOpcodes
+
+OPCODES = os.path.join(os.path.dirname(__file__), "Opcodes.json")
+
+Job = namedtuple("Job", ["rom", "script", "frames"])
+# frame is the final RGB screen buffer, ram the internal ram and hram, seconds the host time of the run
+Result = namedtuple("Result", ["rom", "script", "frames", "cycles", "seconds", "frame", "ram"])
+
+# per worker: opcode tables and rom bytes with their metadata, by path
+_tables = None
+_roms = {}
+
+
+def initWorker(opcodefile):
+    global _tables
+    _tables = getOpcodes(opcodefile)
+
+
+def loadRom(path):
+    rom = _roms.get(path)
+    if rom is None:
+        data = Path(path).read_bytes()
+        rom = _roms[path] = (data, read_cartridge_metadata(data))
+    return rom
+
+
+# frame -> mask of the buttons held from that frame on
+def readScript(path):
+    script = {}
+    for number, line in enumerate(Path(path).read_text().splitlines(), 1):
+        fields = line.split("#", 1)[0].split()
+        if not fields:
+            continue
+        try:
+            script[int(fields[0])] = sum(1 << BUTTONS[button.lower()] for button in set(fields[1:]))
+        except (ValueError, KeyError):
+            raise ValueError(f"{path}:{number}: expected a frame and button names, got {line!r}")
+    return script
+
+
+# presses and releases buttons to go from the held to the wanted mask
+def setButtons(cpu, held, wanted):
+    for bit in BUTTONS.values():
+        if (held ^ wanted) >> bit & 1 and cpu.joypad.handleInput(bit, not wanted >> bit & 1):
+            # Set joypad interrupt
+            cpu.setInterrupt(4)
+    return wanted
+
+
+def runJob(job):
+    rom, metadata = loadRom(job.rom)
+    script = readScript(job.script) if job.script else {}
+    start = time.perf_counter()
+    cpu = CPU(job.rom, metadata, headless=True, rom=rom, tables=_tables)
+    cpu.initVals()
+    held = 0
+    for frame in range(job.frames):
+        wanted = script.get(frame)
+        if wanted is not None:
+            held = setButtons(cpu, held, wanted)
+        cpu.runFrames(1)
+    seconds = time.perf_counter() - start
+    return Result(job.rom, job.script, job.frames, cpu.total_cycles, seconds, cpu.screen.getFrame(),
+                  cpu.decoder.memory.getRAM())
+
+
+# runs jobs on workers processes, results are in the order of the jobs
+def runBatch(jobs, workers=None):
+    if workers == 1:
+        initWorker(OPCODES)
+        return [runJob(job) for job in jobs]
+    with ProcessPoolExecutor(max_workers=workers, initializer=initWorker, initargs=(OPCODES,)) as executor:
+        return list(executor.map(runJob, jobs))
+
+
+def readJobs(path):
+    return [Job(entry["rom"], entry.get("script"), entry["frames"]) for entry in json.loads(Path(path).read_text())]
+
+
+# writes the frame as a ppm image and the ram snapshot of each result
+def saveResults(results, directory):
+    os.makedirs(directory, exist_ok=True)
+    for number, result in enumerate(results):
+        name = os.path.join(directory, f"{number:04d}_{Path(result.rom).stem}")
+        Path(name + ".ppm").write_bytes(b"P6 160 144 255\n" + result.frame)
+        Path(name + ".ram").write_bytes(result.ram)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run roms headless across a process pool")
+    parser.add_argument("roms", nargs="*", help="paths to roms, each run for --frames frames")
+    parser.add_argument("--frames", type=int, default=600, help="frames to run each rom on the command line")
+    parser.add_argument("--script", help="input script for the roms on the command line")
+    parser.add_argument("--jobs", help="json file of jobs, run after the roms on the command line")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes, defaults to the cpu count")
+    parser.add_argument("--out", help="directory to write the final frames (ppm) and ram snapshots to")
+    args = parser.parse_args()
+
+    jobs = [Job(rom, args.script, args.frames) for rom in args.roms]
+    if args.jobs:
+        jobs += readJobs(args.jobs)
+    if not jobs:
+        parser.error("no roms or jobs given")
+    for job in jobs:
+        if not os.path.isfile(job.rom):
+            raise AssertionError(f"Rom path {job.rom} does not exist")
+
+    start = time.perf_counter()
+    results = runBatch(jobs, args.workers)
+    elapsed = time.perf_counter() - start
+    for result in results:
+        print(f"{result.rom}: {result.frames} frames, {result.cycles} cycles in {result.seconds:.2f}s, "
+              f"frame {hashlib.sha1(result.frame).hexdigest()[:12]}, ram {hashlib.sha1(result.ram).hexdigest()[:12]}")
+    emulated = sum(result.seconds for result in results)
+    print(f"{len(results)} jobs in {elapsed:.2f}s ({emulated:.2f}s of runs, {emulated / elapsed:.1f}x parallel)")
+    if args.out:
+        saveResults(results, args.out)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
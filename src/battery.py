@@ -0,0 +1,53 @@
+# Battery backed cartridge ram
+# cython: annotation_typing = False
+# The cartridge ram of battery backed cartridges is kept in a .sav file next to the rom, mapped with mmap.
+# The MBC3 clock is kept after the ram (see memory.RTC_SAVE).
+# The memory runs on its own copy of the ram; the 256 byte pages written since the last store are copied
+# into the map, and the map is flushed to disk on a background thread.
+import mmap
+import os
+import threading
+
+# cartridge types with a battery: mbc1, mbc2, mbc3 (with and without the clock) and mbc5
+BATTERY_TYPES = (0x03, 0x06, 0x0F, 0x10, 0x13, 0x1B, 0x1E)
+# frames between stores of the written ram
+STORE_FRAMES = 60
+
+
+def savePath(filename):
+    return os.path.splitext(filename)[0] + ".sav"
+
+
+class SaveFile:
+    def __init__(self, path, size):
+        self.path = path
+        self.size = size
+        # created, or grown with zeros, to size
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            if os.fstat(fd).st_size < size:
+                os.ftruncate(fd, size)
+            self.map = mmap.mmap(fd, size)
+        finally:
+            # the map keeps its own handle
+            os.close(fd)
+        self.flusher = None
+
+    # copies the 256 byte pages of ram flagged in dirty into the map, then flushes it in the background
+    def store(self, ram, dirty):
+        for page in range(min(len(dirty), self.size >> 8)):
+            if dirty[page]:
+                offset = page << 8
+                self.map[offset:offset + 0x100] = ram[offset:offset + 0x100]
+        # a flush still running leaves the rest to the next store
+        if self.flusher is None or not self.flusher.is_alive():
+            self.flusher = threading.Thread(target=self.map.flush, daemon=True)
+            self.flusher.start()
+
+    def close(self):
+        if self.map.closed:
+            return
+        if self.flusher is not None:
+            self.flusher.join()
+        self.map.flush()
+        self.map.close()
@@ -0,0 +1,230 @@
+# Benchmark
+# Runs a rom for a fixed number of steps and reports the emulated cycles per second.
+# A step is one instruction, or one translated block unless --no-translate is given.
+# Without a rom path a built in loop rom is used: a memory copy + alu + call/ret loop, an alu only loop
+# or a frame loop that busy waits for VBlank.
+import argparse
+import os
+import sys
+import tempfile
+import time
+
+# no window is needed to benchmark
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+
+from cartridge import get_cartridge_metadata
+from cpu import CPU, POLL_CYCLES
+from rewind import Rewind
+
+# Game Boy clock in cycles per second
+CLOCK = 4194304
+
+# Program placed at 0x150, loops forever
+LOOP = [
+    0x31, 0xF0, 0xDF,  # 0x150 LD SP,$DFF0
+    0x21, 0x00, 0xC0,  # 0x153 LD HL,$C000
+    0x11, 0x00, 0x02,  # 0x156 LD DE,$0200
+    0x06, 0x40,        # 0x159 LD B,$40
+    0x1A,              # 0x15B LD A,(DE)
+    0x22,              # 0x15C LD (HL+),A
+    0x13,              # 0x15D INC DE
+    0x05,              # 0x15E DEC B
+    0x20, 0xFA,        # 0x15F JR NZ,$015B
+    0x0E, 0x20,        # 0x161 LD C,$20
+    0x81,              # 0x163 ADD A,C
+    0xA8,              # 0x164 XOR B
+    0xD6, 0x03,        # 0x165 SUB $03
+    0x07,              # 0x167 RLCA
+    0xCD, 0x80, 0x01,  # 0x168 CALL $0180
+    0x0D,              # 0x16B DEC C
+    0x20, 0xF5,        # 0x16C JR NZ,$0163
+    0xC3, 0x53, 0x01,  # 0x16E JP $0153
+]
+
+# Subroutine placed at 0x180
+SUBROUTINE = [
+    0xE6, 0x7F,  # 0x180 AND $7F
+    0xB2,        # 0x182 OR D
+    0xC9,        # 0x183 RET
+]
+
+# Alu only program placed at 0x150, loops forever
+ALU_LOOP = [
+    0x3E, 0x01,        # 0x150 LD A,$01
+    0x06, 0x03,        # 0x152 LD B,$03
+    0x0E, 0x05,        # 0x154 LD C,$05
+    0x16, 0x07,        # 0x156 LD D,$07
+    0x1E, 0x40,        # 0x158 LD E,$40
+    0x80,              # 0x15A ADD A,B
+    0x89,              # 0x15B ADC A,C
+    0x92,              # 0x15C SUB D
+    0x98,              # 0x15D SBC A,B
+    0xA9,              # 0x15E XOR C
+    0xE6, 0x7F,        # 0x15F AND $7F
+    0xB2,              # 0x161 OR D
+    0xB8,              # 0x162 CP B
+    0x04,              # 0x163 INC B
+    0x0D,              # 0x164 DEC C
+    0x14,              # 0x165 INC D
+    0x07,              # 0x166 RLCA
+    0xC6, 0x11,        # 0x167 ADD A,$11
+    0x1D,              # 0x169 DEC E
+    0x20, 0xEE,        # 0x16A JR NZ,$015A
+    0xC3, 0x58, 0x01,  # 0x16C JP $0158
+]
+
+# Frame loop placed at 0x150: a memory copy, then busy waits for VBlank to start and end
+IDLE_LOOP = [
+    0x31, 0xF0, 0xDF,  # 0x150 LD SP,$DFF0
+    0x21, 0x00, 0xC0,  # 0x153 LD HL,$C000
+    0x11, 0x00, 0x02,  # 0x156 LD DE,$0200
+    0x06, 0x40,        # 0x159 LD B,$40
+    0x1A,              # 0x15B LD A,(DE)
+    0x22,              # 0x15C LD (HL+),A
+    0x13,              # 0x15D INC DE
+    0x05,              # 0x15E DEC B
+    0x20, 0xFA,        # 0x15F JR NZ,$015B
+    0xF0, 0x44,        # 0x161 LDH A,($44)
+    0xFE, 0x90,        # 0x163 CP $90
+    0x20, 0xFA,        # 0x165 JR NZ,$0161
+    0xF0, 0x44,        # 0x167 LDH A,($44)
+    0xFE, 0x90,        # 0x169 CP $90
+    0x28, 0xFA,        # 0x16B JR Z,$0167
+    0xC3, 0x53, 0x01,  # 0x16D JP $0153
+]
+
+PROGRAMS = {"mixed": LOOP, "alu": ALU_LOOP, "idle": IDLE_LOOP}
+
+
+def buildLoopRom(program="mixed"):
+    rom = bytearray(0x8000)
+    # entrypoint: NOP; JP $0150
+    rom[0x100:0x104] = bytes([0x00, 0xC3, 0x50, 0x01])
+    rom[0x134:0x13D] = b"BENCHMARK"
+    code = PROGRAMS[program]
+    rom[0x150:0x150 + len(code)] = bytes(code)
+    rom[0x180:0x180 + len(SUBROUTINE)] = bytes(SUBROUTINE)
+    # data copied by the loop
+    rom[0x200:0x240] = bytes(range(0x40))
+    return bytes(rom)
+
+
+# counts the calls and host time of pygame.event.get, to measure input polling
+class PollTimer:
+    def __init__(self, events):
+        self.events = events
+        self.get = events.get
+        self.calls = 0
+        self.time = 0
+
+    def __call__(self, *args, **kwargs):
+        start = time.perf_counter()
+        events = self.get(*args, **kwargs)
+        self.time += time.perf_counter() - start
+        self.calls += 1
+        return events
+
+
+def run(filename, steps, translate, input_poll, idle_skip, headless):
+    cpu = CPU(filename, get_cartridge_metadata(filename), translate=translate, input_poll=input_poll,
+              idle_skip=idle_skip, headless=headless)
+    cpu.initVals()
+    if headless:
+        polls = None
+    else:
+        import pygame
+        polls = pygame.event.get = PollTimer(pygame.event)
+    try:
+        start = time.perf_counter()
+        cpu.runSteps(steps)
+        elapsed = time.perf_counter() - start
+    finally:
+        if polls is not None:
+            polls.events.get = polls.get
+    polling = (0, 0) if polls is None else (polls.calls, polls.time / elapsed)
+    return (cpu.total_cycles / elapsed, elapsed / steps, cpu.decoder.cacheStats(), polling,
+            (cpu.idle_total / cpu.total_cycles, cpu.idle_last_frame))
+
+
+# host time to decode a tile into the tile cache, over count tiles of the video ram after a frame
+def runTiles(filename, count):
+    cpu = CPU(filename, get_cartridge_metadata(filename), headless=True)
+    cpu.initVals()
+    cpu.runFrames(1)
+    start = time.perf_counter()
+    cpu.screen.decodeTiles(count)
+    return (time.perf_counter() - start) / count
+
+
+# records frames with rewind, then steps one frame back
+def runRewind(filename, frames, interval, budget, translate, idle_skip):
+    cpu = CPU(filename, get_cartridge_metadata(filename), translate=translate, idle_skip=idle_skip, headless=True)
+    cpu.initVals()
+    rewind = Rewind(cpu, interval, budget)
+    rewind.runFrames(frames)
+    history, states, used, record_time = rewind.stats()
+    start = time.perf_counter()
+    rewind.stepBack()
+    step_back = time.perf_counter() - start
+    # frames that fit in the budget at the delta size seen
+    delta = (used - len(rewind.latest)) / history if history else 0
+    capacity = (budget - len(rewind.latest)) / delta if delta else 0
+    return history, states, used, record_time, step_back, capacity
+
+
+def main():
+    parser = argparse.ArgumentParser(description="PyGB throughput benchmark")
+    parser.add_argument("rom", nargs="?", help="path to rom, defaults to a built in loop")
+    parser.add_argument("--program", choices=PROGRAMS, default="mixed", help="built in loop to run without a rom")
+    parser.add_argument("--steps", type=int, default=1000000, help="number of steps to run")
+    parser.add_argument("--repeat", type=int, default=3, help="number of runs, the best is reported")
+    parser.add_argument("--no-translate", action="store_true", help="interpret every instruction")
+    parser.add_argument("--no-idle-skip", action="store_true", help="run busy wait loops instead of skipping them")
+    parser.add_argument("--input-poll", choices=POLL_CYCLES, default="frame", help="how often host input is polled")
+    parser.add_argument("--headless", action="store_true", help="run without a window, pygame is not imported")
+    parser.add_argument("--rewind", type=int, default=0, metavar="N",
+                        help="also measure rewind, with a state every N frames")
+    parser.add_argument("--rewind-budget", type=float, default=4, help="rewind memory budget in MiB")
+    parser.add_argument("--rewind-frames", type=int, default=300, help="frames to record for the rewind measure")
+    parser.add_argument("--tiles", type=int, default=0, metavar="N", help="also time decoding N tiles into the tile cache")
+    args = parser.parse_args()
+
+    filename = args.rom
+    if filename is None:
+        handle, filename = tempfile.mkstemp(suffix=".gb")
+        with os.fdopen(handle, "wb") as f:
+            f.write(buildLoopRom(args.program))
+    elif not os.path.isfile(filename):
+        raise AssertionError(f"Rom path {filename} does not exist")
+
+    rewind = None
+    tile_time = None
+    try:
+        best, step_time, (hits, misses), (polls, poll_share), (idle_share, idle_frame) = max(
+            run(filename, args.steps, not args.no_translate, args.input_poll, not args.no_idle_skip, args.headless)
+            for _ in range(args.repeat))
+        if args.rewind:
+            budget = int(args.rewind_budget * (1 << 20))
+            rewind = runRewind(filename, args.rewind_frames, args.rewind, budget, not args.no_translate,
+                               not args.no_idle_skip)
+        if args.tiles:
+            tile_time = min(runTiles(filename, args.tiles) for _ in range(args.repeat))
+    finally:
+        if args.rom is None:
+            os.remove(filename)
+    print(f"{args.steps} steps, best of {args.repeat}: {best:,.0f} cycles/s ({best / CLOCK:.2f}x real time), "
+          f"{step_time * 1e9:,.0f} ns/step")
+    print(f"decode cache: {hits} hits, {misses} misses")
+    print(f"input polling: {polls} polls, {poll_share:.2%} of host time")
+    print(f"idle loops: {idle_share:.1%} of cycles skipped, {idle_frame} in the last frame")
+    if tile_time is not None:
+        print(f"tile decode: {args.tiles} tiles, {tile_time * 1e6:.2f} us/tile")
+    if rewind is not None:
+        history, states, used, record_time, step_back, capacity = rewind
+        print(f"rewind: a state every {args.rewind} frames, {states} states covering {history} frames in "
+              f"{used / 1024:,.0f} KiB, {record_time * 1e6:,.0f} us/frame to record, {step_back * 1e3:.1f} ms to step back, "
+              f"the {args.rewind_budget:g} MiB budget holds about {capacity / 60:,.0f} s")
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -37,5 +37,6 @@ def read_cartridge_metadata(buffer, offset: int = 0x100):
     return CartridgeMetadata._make(data)
 
 def get_cartridge_metadata(filename):
-    p = Path(filename)
-    return read_cartridge_metadata(p.read_bytes())
+    # only the header is read
+    with Path(filename).open("rb") as f:
+        return read_cartridge_metadata(f.read(0x150))
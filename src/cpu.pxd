@@ -5,13 +5,13 @@ cimport disassemble
 cimport timer
 cimport screen
 cimport joypad
+cimport scheduler
 
 
-cdef class InstructionError(Exception):
-    pass
-
 cdef class CPU:
     cdef public registers
+    cdef object metadata
+    cdef public object display
     cdef public disassemble.Decoder decoder
     cdef public uint8_t i_master, i_enable, i_flag
     cdef public bint i_queue, halt
@@ -19,54 +19,53 @@ cdef class CPU:
     cdef public timer.Timer timer
     cdef public screen.Screen screen
     cdef public joypad.Joypad joypad
-    cdef public uint8_t sync_cycles, cycles
+    cdef public scheduler.Scheduler scheduler
+    cdef public uint32_t cycles
+    cdef public uint64_t total_cycles, frames
+    cdef public list handlers
+    cdef public object translator
     cdef uint64_t maxcycles
+    cdef uint32_t poll_cycles
+    cdef public bint idle_skip
+    cdef int idle_head, idle_rejected, idle_backoff, idle_misses
+    cdef tuple idle_state
+    cdef uint64_t idle_start, idle_deadline
+    cdef dict idle_changes
+    cdef public uint64_t idle_frame, idle_last_frame, idle_total
     cdef float cputime, screentime
     cpdef initVals(self)
-    @cython.locals(val=uint16_t)
-    cdef inline void POP(self, object)
-    @cython.locals(val=uint16_t)
-    cdef inline void PUSH(self, object)
-    cdef inline void JP(self, uint16_t)
-    @cython.locals(val=uint16_t,res=uint16_t)
-    cdef inline void CP(self, object)
-    @cython.locals(val=uint16_t,res=uint16_t)
-    cdef inline void XOR(self, object)
-    @cython.locals(val=uint16_t,res=uint16_t,carry=uint16_t)
-    cdef inline void SBC(self, object)
-    @cython.locals(val=uint16_t,res=uint16_t,carry=uint16_t)
-    cdef inline void ADC(self, object)
-    @cython.locals(val=uint16_t,res=uint16_t)
-    cdef inline void OR(self, object)
-    @cython.locals(val=uint16_t,res=uint16_t)
-    cdef inline void AND(self, object)
-    @cython.locals(val=uint16_t)
-    cdef inline void DEC(self, object)
-    @cython.locals(val=uint16_t)
-    cdef inline void INC(self, object)
-    @cython.locals(val=uint16_t,res=uint16_t)
-    cdef inline void ADD(self, object, object)
-    @cython.locals(val=uint16_t,res=uint16_t)
-    cdef inline void SUB(self, object)
-    @cython.locals(sp=uint16_t,pc=uint16_t)
-    cdef inline void RET(self)
-    @cython.locals(sp=uint16_t,pc=uint16_t)
-    cdef inline void CALL(self, uint16_t)
-    cdef inline void JR(self, object)
-    @cython.locals(opcode=int, shift=int, reg=int, ptr=uint16_t, res=int, val=int)
-    cdef uint8_t execute(self, object, bint)
     cpdef void run(self)
+    cpdef void runSteps(self, uint64_t)
+    @cython.locals(target=uint64_t)
+    cpdef void runFrames(self, uint64_t)
     cdef void generateLog(self, object)
-    @cython.locals(timer_inter=bint, cycles=uint8_t)
+    @cython.locals(cycles=uint64_t, pc=int, jumped=bint)
     cdef void update(self)
-    @cython.locals(address=uint16_t, wrapper=object, next_address=uint16_t, instruction=object, cb=bint, cycles=uint8_t)
-    cdef uint8_t executeNextOp(self)
+    @cython.locals(address=uint16_t, decoded=uint32_t, handler=object, block=object, cycles=uint32_t)
+    cdef uint32_t executeNextOp(self)
+    @cython.locals(cycles=uint64_t)
+    cdef uint64_t haltCycles(self)
+    @cython.locals(now=uint64_t, cycles=uint64_t)
+    cpdef void sync(self)
+    @cython.locals(pc=int, state=tuple)
+    cdef void idleCheck(self, bint)
+    @cython.locals(synced=uint64_t, changes=dict, address=int)
+    cdef void idleWatch(self, int, tuple)
+    @cython.locals(changes=dict, horizon=uint64_t, now=uint64_t, length=uint64_t, skipped=uint64_t)
+    cdef void idleSkip(self, list)
+    cpdef bytes saveState(self)
+    @cython.locals(parts=list, offset=int, length=int)
+    cpdef void loadState(self, data)
+    cpdef void saveStateFile(self, object)
+    cpdef void loadStateFile(self, object)
+    cpdef void endFrame(self)
     @cython.locals(flag=uint8_t)
     cpdef void setInterrupt(self, uint8_t)
     @cython.locals(total=int)
     cdef bint checkInterrupt(self)
+    @cython.locals(sp=uint16_t, pc=uint16_t)
     cdef void handleInterrupt(self, uint8_t, uint16_t)
     @cython.locals(temp=bint)
     cdef void blargg_update(self)
-    @cython.locals(updog=bint, interrupt=bint)
+    @cython.locals(bit=object)
     cdef void handleEvents(self)
\ No newline at end of file
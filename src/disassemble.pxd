@@ -4,17 +4,23 @@ from libc.stdint cimport int64_t, uint8_t, uint16_t, uint32_t, uint64_t
 cimport memory
 
 cdef class Decoder:
-    cdef memory.Memory memory
+    cdef public memory.Memory memory
     cdef uint64_t address
     cdef list unprefixed, cbprefixed
+    cdef public list instructions
+    cdef bytes immediate_bytes
+    cdef dict bank_caches
+    cdef list rom_cache_low, rom_cache_high, ram_cache
+    cdef public uint64_t cache_hits, cache_misses
+    cdef list getBankCache(self, uint16_t)
+    cpdef void selectBank(self, uint16_t)
+    cpdef void clearRAMCache(self)
     cpdef uint16_t getMem(self, uint16_t, uint8_t counter=*)
     cpdef void setMem(self, uint16_t, uint8_t)
-    @cython.locals(opcode=int,cbbool=bint,oparr=list,operand=object)
-    cdef Wrapper decode(self, uint16_t)
-
-cdef class Wrapper:
-    cdef public uint16_t address
-    cdef public object instruction
-    cdef public bint cbbool
+    @cython.locals(opcode=uint32_t,length=uint32_t,count=uint8_t,value=uint32_t)
+    cpdef uint32_t decode(self, uint16_t)
+    @cython.locals(cache=list,index=int,end=int,decoded=uint32_t)
+    cdef uint32_t fetch(self, uint16_t)
+    cpdef tuple cacheStats(self)
 
 cdef disassemble(Decoder, uint16_t, int)
\ No newline at end of file
@@ -4,6 +4,9 @@ from cartridge import CartridgeMetadata
 from memory import Memory
 from pathlib import Path
 
+# empty decoded instruction cache entries, for clearing the ram ones
+CLEARED = [0] * 0x2000
+
 @dataclass
 class Decoder:
     # game data
@@ -13,74 +16,138 @@ class Decoder:
     # instructions
     unprefixed: list
     cbprefixed: list
+    instructions: list
+    immediate_bytes: bytes
+    # decoded instruction caches
+    bank_caches: dict
+    rom_cache_low: list
+    rom_cache_high: list
+    ram_cache: list
+    cache_hits: int
+    cache_misses: int
 
-    def __init__(self, opcodefile: str, filename: str, metadata: CartridgeMetadata, cpu, address):
-        self.unprefixed, self.cbprefixed = opcodes.getOpcodes(opcodefile)
-        self.memory = Memory(Path(filename).read_bytes(), metadata, cpu)
+    # rom bytes and opcode tables already loaded can be passed in to share them between emulators
+    def __init__(self, opcodefile: str, filename: str, metadata: CartridgeMetadata, cpu, address, rom=None, tables=None):
+        if tables is None:
+            tables = opcodes.getOpcodes(opcodefile)
+        self.unprefixed, self.cbprefixed = tables
+        if rom is None:
+            rom = Path(filename).read_bytes()
+        # instructions and their immediate operand sizes by opcode index, the tables are never modified
+        self.instructions = [None] * 0x200
+        for instruction in self.unprefixed:
+            self.instructions[instruction.opcode] = instruction
+        for instruction in self.cbprefixed:
+            self.instructions[0x100 | instruction.opcode] = instruction
+        self.immediate_bytes = bytes(sum(operand.bytes or 0 for operand in instruction.operands)
+                                     for instruction in self.instructions)
+        self.memory = Memory(rom, metadata, cpu)
         self.address = address
 
+        # Decoded instructions running from rom, one list of 0x4000 entries per rom bank
+        self.bank_caches = {}
+        self.rom_cache_low = self.getBankCache(0)
+        self.rom_cache_high = self.getBankCache(1)
+        # Decoded instructions running from internal ram and hram, indexed by address
+        # memory clears the entries on writes
+        self.ram_cache = [0] * 0x10000
+        self.memory.code_cache = self.ram_cache
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    # get (or create) the decoded instruction cache of a rom bank
+    def getBankCache(self, bank):
+        cache = self.bank_caches.get(bank)
+        if cache is None:
+            cache = [0] * 0x4000
+            self.bank_caches[bank] = cache
+        return cache
+
+    # called by memory on mbc bank switches, points the 0x4000-0x7FFF window at the bank's cache
+    def selectBank(self, bank):
+        self.rom_cache_high = self.getBankCache(bank)
+
+    # drops the decoded instructions in ram, after its contents were replaced
+    def clearRAMCache(self):
+        self.ram_cache[0xC000:0xE000] = CLEARED
+        self.ram_cache[0xFF80:0x10000] = CLEARED[0:0x80]
+
     # get bytes from memory
     def getMem(self, address, counter = 1):
-        return self.memory.get(address, counter)
+        if counter > 1:
+            return self.memory.read16(address)
+        return self.memory.read8(address)
 
     # set bytes at memory
     def setMem(self, address, value):
-        self.memory.set(address, value)
+        self.memory.write8(address, value)
 
-    # decodes instruction at address
+    # decodes instruction at address into an int: the immediate value in bits 0-15, the opcode index
+    # in bits 16-24 (0x100 + opcode for cb prefixed instructions) and the length in bytes from bit 25
     def decode(self, address):
         # opcode = item at pc
-        opcode = self.getMem(address)
-        cbbool = False
-        # iterate pc
-        address += 1
-        # if prefixed opcode, read next item and get cb instruction
+        opcode = self.memory.read8(address)
+        length = 1
+        # if prefixed opcode, read next item for the cb instruction
         if opcode == 0xCB:
-            opcode = self.getMem(address)
-            address += 1
-            instruction = self.cbprefixed[opcode]
-            cbbool = True
-        # if not, get instruction normally
+            opcode = 0x100 | self.memory.read8((address + 1) & 0xFFFF)
+            length = 2
+        # immediate value passed to the opcode handler
+        value = 0
+        count = self.immediate_bytes[opcode]
+        if count == 1:
+            value = self.memory.read8((address + length) & 0xFFFF)
+        elif count == 2:
+            value = self.memory.read16((address + length) & 0xFFFF)
+        length += count
+        return length << 25 | opcode << 16 | value
+
+    # decodes instruction at address, reusing the cached decode for code in rom, internal ram or hram
+    def fetch(self, address):
+        if address < 0x4000:
+            cache = self.rom_cache_low
+            index = address
+            end = 0x4000
+        elif address < 0x8000:
+            cache = self.rom_cache_high
+            index = address - 0x4000
+            end = 0x8000
+        elif 0xC000 <= address < 0xE000:
+            cache = self.ram_cache
+            index = address
+            end = 0xE000
+        elif 0xFF80 <= address < 0xFFFF:
+            cache = self.ram_cache
+            index = address
+            end = 0xFFFF
         else:
-            instruction = self.unprefixed[opcode]
-        # operand array
-        oparr = []
+            self.cache_misses += 1
+            return self.decode(address)
 
-        # for each operand in instruction operand
-        for operand in instruction.operands:
-            # if bytes its a memory address, and read the bytes
-            if operand.bytes is not None:
-                # read memory value
-                val = self.getMem(address, operand.bytes)
-                address += operand.bytes
-                # create operand copy with value stored
-                operand.setValue(val)
-                oparr.append(operand)
-            # if no bytes, not memory address
-            else:
-                oparr.append(operand)
-        # Copy instruction and set new operands
-        instruction.setOperands(oparr)
-        return Wrapper(address, instruction, cbbool)
+        decoded = cache[index]
+        if decoded:
+            self.cache_hits += 1
+            return decoded
 
-# exists only to return instruction object since Cython doesn't allow objects in tuples
-class Wrapper:
-    address: int
-    instruction: object
-    cbbool: bool
-    def __init__(self, a, b, c):
-        self.address = a
-        self.instruction = b
-        self.cbbool = c
+        self.cache_misses += 1
+        decoded = self.decode(address)
+        # instructions crossing into another region depend on more than the key
+        if decoded >> 25 <= end - address:
+            cache[index] = decoded
+        return decoded
+
+    # hits / misses of the decoded instruction cache
+    def cacheStats(self):
+        return self.cache_hits, self.cache_misses
 
 def disassemble(decoder: Decoder, address, count):
     for _ in range(count):
         try:
-            wrapper = decoder.decode(address)
-            new_address, instruction, cb = wrapper.address, wrapper.instruction, wrapper.cbbool
-            pp = instruction.print()
+            decoded = decoder.decode(address)
+            instruction = decoder.instructions[(decoded >> 16) & 0x1FF]
+            pp = instruction.print(decoded & 0xFFFF)
             print(f'{address:>04X} {pp}')
-            address = new_address
+            address = (address + (decoded >> 25)) & 0xFFFF
         except IndexError as e:
             print('ERROR - {e!s}')
             break
@@ -0,0 +1,621 @@
+# Dispatch tables
+# cython: annotation_typing = False
+# Every opcode is mapped to a handler closure built once from its Instruction. The operand kinds
+# (register, (HL), immediate, condition...) are resolved here, so a handler only receives the
+# immediate value read by the decoder and returns the number of cycles it took.
+from registers import B, C, D, E, H, L, F, A, REGISTERS_8, REGISTERS_16, FLAG_Z, FLAG_C
+
+
+class InstructionError(Exception):
+    pass
+
+
+# Constants
+# condition -> (flag mask, expected)
+CONDITIONS = {"NZ": (FLAG_Z, 0), "Z": (FLAG_Z, FLAG_Z), "NC": (FLAG_C, 0), "C": (FLAG_C, FLAG_C)}
+
+
+# Builds the handler table for cpu, indexed like the decoder (0x100 + opcode for cb prefixed instructions)
+def buildTables(cpu, unprefixed, cbprefixed):
+    handlers = [None] * 0x200
+    for instruction in unprefixed:
+        handlers[instruction.opcode] = buildHandler(cpu, instruction)
+    for instruction in cbprefixed:
+        handlers[0x100 | instruction.opcode] = buildCBHandler(cpu, instruction)
+    return handlers
+
+
+# ALU helpers on the register slots, shared by the register, (HL) and immediate variants
+def _add(r, res):
+    val = r[A]
+    total = val + res
+    # flags
+    r[F] = ((total & 0xFF) == 0) << 7 | ((val & 0xF) + (res & 0xF) > 0xF) << 5 | (total > 0xFF) << 4
+    # Set register value
+    r[A] = total & 0xFF
+
+
+def _adc(r, res):
+    val = r[A]
+    carry = r[F] >> 4 & 1
+    total = val + res + carry
+    # flags
+    r[F] = ((total & 0xFF) == 0) << 7 | ((val & 0xF) + (res & 0xF) + carry > 0xF) << 5 | (total > 0xFF) << 4
+    # Set register value
+    r[A] = total & 0xFF
+
+
+def _sub(r, res):
+    val = r[A]
+    total = val - res
+    # Flags
+    r[F] = ((total & 0xFF) == 0) << 7 | 0x40 | ((val & 0xF) < (res & 0xF)) << 5 | (total < 0) << 4
+    # set
+    r[A] = total & 0xFF
+
+
+def _sbc(r, res):
+    val = r[A]
+    carry = r[F] >> 4 & 1
+    total = val - res - carry
+    # Flags
+    r[F] = ((total & 0xFF) == 0) << 7 | 0x40 | ((val & 0xF) - (res & 0xF) - carry < 0) << 5 | (total < 0) << 4
+    # set
+    r[A] = total & 0xFF
+
+
+def _and(r, res):
+    val = r[A] & res
+    r[A] = val
+    # Flags
+    r[F] = (val == 0) << 7 | 0x20
+
+
+def _xor(r, res):
+    val = r[A] ^ res
+    r[A] = val
+    # Flags
+    r[F] = (val == 0) << 7
+
+
+def _or(r, res):
+    val = r[A] | res
+    r[A] = val
+    # Flags
+    r[F] = (val == 0) << 7
+
+
+def _cp(r, res):
+    val = r[A]
+    # Flags
+    r[F] = (val == res) << 7 | 0x40 | ((val & 0xF) < (res & 0xF)) << 5 | (val < res) << 4
+
+
+ALU = {"ADD": _add, "ADC": _adc, "SUB": _sub, "SBC": _sbc, "AND": _and, "XOR": _xor, "OR": _or, "CP": _cp}
+
+
+# Increment/decrement helpers, return the new value
+def _inc(r, val):
+    val = (val + 1) & 0xFF
+    # flags, carry is kept
+    r[F] = r[F] & 0x10 | (val == 0) << 7 | ((val & 0xF) == 0) << 5
+    return val
+
+
+def _dec(r, val):
+    val = (val - 1) & 0xFF
+    # flags, carry is kept
+    r[F] = r[F] & 0x10 | (val == 0) << 7 | 0x40 | ((val & 0xF) == 0xF) << 5
+    return val
+
+
+# Rotate/shift helpers, return the result with the carry in bit 8
+def _rlc(r, reg):
+    return (reg << 1) + (reg >> 7)
+
+
+def _rrc(r, reg):
+    return (reg >> 1) + ((reg & 1) << 7) + ((reg & 1) << 8)
+
+
+def _rl(r, reg):
+    return (reg << 1) + (r[F] >> 4 & 1)
+
+
+def _rr(r, reg):
+    return (reg >> 1) + ((r[F] >> 4 & 1) << 7) + ((reg & 1) << 8)
+
+
+def _sla(r, reg):
+    return reg << 1
+
+
+def _sra(r, reg):
+    return ((reg >> 1) | (reg & 0x80)) + ((reg & 1) << 8)
+
+
+def _srl(r, reg):
+    return (reg >> 1) + ((reg & 1) << 8)
+
+
+def _swap(r, reg):
+    return ((reg & 0xF0) >> 4) | ((reg & 0x0F) << 4)
+
+
+SHIFTS = {"RLC": _rlc, "RRC": _rrc, "RL": _rl, "RR": _rr, "SLA": _sla, "SRA": _sra, "SRL": _srl, "SWAP": _swap}
+ROTATES_A = {"RLCA": _rlc, "RRCA": _rrc, "RLA": _rl, "RRA": _rr}
+
+
+def buildHandler(cpu, instruction):
+    regs = cpu.registers
+    r = regs.r
+    memory = cpu.decoder.memory
+    read8, read16 = memory.read8, memory.read16
+    write8, write16 = memory.write8, memory.write16
+    mnemonic = instruction.mnemonic
+    operands = instruction.operands
+    names = [operand.name for operand in operands]
+    cycles = instruction.cycles[0]
+    # cycles when a conditional branch is not taken
+    skipped = instruction.cycles[-1]
+
+    def push(val):
+        sp = (regs.SP - 2) & 0xFFFF
+        write16(sp, val)
+        regs.SP = sp
+
+    def ret():
+        sp = regs.SP
+        regs.PC = read16(sp)
+        regs.SP = (sp + 2) & 0xFFFF
+
+    # Condition check for conditional jumps, calls and returns
+    condition = None
+    if mnemonic in ("JP", "JR", "CALL", "RET") and names and names[0] in CONDITIONS:
+        condition = CONDITIONS[names[0]]
+
+    if mnemonic in ("NOP", "STOP"):
+        def op(value):
+            return cycles
+    elif mnemonic == "HALT":
+        def op(value):
+            cpu.halt = True
+            return cycles
+    elif mnemonic == "DI":
+        def op(value):
+            cpu.i_master = 0
+            return cycles
+    elif mnemonic == "EI":
+        def op(value):
+            cpu.i_master = 1
+            return cycles
+    elif mnemonic == "PREFIX":
+        def op(value):
+            raise InstructionError(f"Instruction {instruction} is illegal")
+    elif mnemonic.startswith("ILLEGAL"):
+        def op(value):
+            raise InstructionError(f"Unimplemented instruction: {instruction}")
+
+    elif mnemonic == "LD" or mnemonic == "LDH":
+        op = buildLoad(cpu, instruction, cycles)
+
+    elif mnemonic in ("INC", "DEC"):
+        name = names[0]
+        step = 1 if mnemonic == "INC" else -1
+        if name == "SP":
+            def op(value):
+                regs.SP = (regs.SP + step) & 0xFFFF
+                return cycles
+        elif name in REGISTERS_16 and operands[0].immediate:
+            hi, lo = REGISTERS_16[name]
+
+            def op(value):
+                regs.set16(hi, lo, regs.get16(hi, lo) + step)
+                return cycles
+        else:
+            alter = _inc if mnemonic == "INC" else _dec
+            if name in REGISTERS_8:
+                slot = REGISTERS_8[name]
+
+                def op(value):
+                    r[slot] = alter(r, r[slot])
+                    return cycles
+            else:
+                def op(value):
+                    ptr = r[H] << 8 | r[L]
+                    val = alter(r, read8(ptr))
+                    # set
+                    cpu.cycles += 4
+                    write8(ptr, val)
+                    return cycles
+
+    elif mnemonic == "ADD" and names[0] == "HL":
+        src = names[1]
+        if src == "SP":
+            def source():
+                return regs.SP
+        else:
+            hi, lo = REGISTERS_16[src]
+
+            def source():
+                return r[hi] << 8 | r[lo]
+
+        def op(value):
+            val = r[H] << 8 | r[L]
+            res = source()
+            # flags, zero is kept
+            r[F] = r[F] & 0x80 | ((val & 0xFFF) + (res & 0xFFF) > 0xFFF) << 5 | (val + res > 0xFFFF) << 4
+            # Set register value
+            regs.set16(H, L, val + res)
+            return cycles
+    elif mnemonic == "ADD" and names[0] == "SP":
+        def op(value):
+            val = regs.SP
+            # flags
+            r[F] = ((val & 0xF) + (value & 0xF) > 0xF) << 5 | ((val & 0xFF) + (value & 0xFF) > 0xFF) << 4
+            # Set register value
+            regs.SP = (val + ((value ^ 0x80) - 0x80)) & 0xFFFF
+            return cycles
+    elif mnemonic in ALU:
+        alu = ALU[mnemonic]
+        # the source is always the last operand
+        source = operands[-1]
+        if source.bytes is not None:
+            def op(value):
+                alu(r, value)
+                return cycles
+        elif source.name in REGISTERS_8:
+            slot = REGISTERS_8[source.name]
+
+            def op(value):
+                alu(r, r[slot])
+                return cycles
+        else:
+            def op(value):
+                alu(r, read8(r[H] << 8 | r[L]))
+                return cycles
+
+    elif mnemonic in ROTATES_A:
+        rotate = ROTATES_A[mnemonic]
+
+        def op(value):
+            val = rotate(r, r[A])
+            # Flags
+            r[F] = (val > 0xFF) << 4
+            # Set
+            r[A] = val & 0xFF
+            return cycles
+    elif mnemonic == "DAA":
+        def op(value):
+            t = r[A]
+            flags = r[F]
+            corr = 0
+            corr |= 0x06 if flags & 0x20 else 0x00
+            corr |= 0x60 if flags & 0x10 else 0x00
+            if flags & 0x40:
+                t -= corr
+            else:
+                corr |= 0x06 if (t & 0x0F) > 0x09 else 0x00
+                corr |= 0x60 if t > 0x99 else 0x00
+                t += corr
+            t &= 0xFF
+            # flags, subtract is kept
+            r[F] = flags & 0x40 | (t == 0) << 7 | ((corr & 0x60) != 0) << 4
+            # set
+            r[A] = t
+            return cycles
+    elif mnemonic == "CPL":
+        def op(value):
+            r[A] = ~r[A] & 0xFF
+            r[F] |= 0x60
+            return cycles
+    elif mnemonic == "SCF":
+        def op(value):
+            r[F] = r[F] & 0x80 | 0x10
+            return cycles
+    elif mnemonic == "CCF":
+        def op(value):
+            r[F] = r[F] & 0x80 | (r[F] & 0x10 ^ 0x10)
+            return cycles
+
+    elif mnemonic == "JP":
+        if names[-1] == "HL":
+            def op(value):
+                regs.PC = r[H] << 8 | r[L]
+                return cycles
+        elif condition is None:
+            def op(value):
+                regs.PC = value
+                return cycles
+        else:
+            mask, expected = condition
+
+            def op(value):
+                if r[F] & mask == expected:
+                    regs.PC = value
+                    return cycles
+                return skipped
+    elif mnemonic == "JR":
+        if condition is None:
+            def op(value):
+                regs.PC = (regs.PC + ((value ^ 0x80) - 0x80)) & 0xFFFF
+                return cycles
+        else:
+            mask, expected = condition
+
+            def op(value):
+                if r[F] & mask == expected:
+                    regs.PC = (regs.PC + ((value ^ 0x80) - 0x80)) & 0xFFFF
+                    return cycles
+                return skipped
+    elif mnemonic == "CALL":
+        if condition is None:
+            def op(value):
+                push(regs.PC)
+                regs.PC = value
+                return cycles
+        else:
+            mask, expected = condition
+
+            def op(value):
+                if r[F] & mask == expected:
+                    push(regs.PC)
+                    regs.PC = value
+                    return cycles
+                return skipped
+    elif mnemonic == "RST":
+        vector = int(names[0][:-1], 16)
+
+        def op(value):
+            push(regs.PC)
+            regs.PC = vector
+            return cycles
+    elif mnemonic == "RET":
+        if condition is None:
+            def op(value):
+                ret()
+                return cycles
+        else:
+            mask, expected = condition
+
+            def op(value):
+                if r[F] & mask == expected:
+                    ret()
+                    return cycles
+                return skipped
+    elif mnemonic == "RETI":
+        def op(value):
+            cpu.i_master = True
+            ret()
+            return cycles
+
+    elif mnemonic == "PUSH":
+        hi, lo = REGISTERS_16[names[0]]
+
+        def op(value):
+            sp = (regs.SP - 2) & 0xFFFF
+            write16(sp, r[hi] << 8 | r[lo])
+            regs.SP = sp
+            return cycles
+    elif mnemonic == "POP":
+        name = names[0]
+        if name == "AF":
+            def op(value):
+                sp = regs.SP
+                val = read16(sp)
+                regs.SP = (sp + 2) & 0xFFFF
+                r[A] = val >> 8
+                # the low bits of F don't exist
+                r[F] = val & 0xF0
+                return cycles
+        else:
+            hi, lo = REGISTERS_16[name]
+
+            def op(value):
+                val = read16(regs.SP)
+                regs.SP = (regs.SP + 2) & 0xFFFF
+                r[hi] = val >> 8
+                r[lo] = val & 0xFF
+                return cycles
+    else:
+        raise InstructionError(f"No handler for instruction: {instruction}")
+    return op
+
+
+def buildLoad(cpu, instruction, cycles):
+    regs = cpu.registers
+    r = regs.r
+    memory = cpu.decoder.memory
+    read8, write8, write16 = memory.read8, memory.write8, memory.write16
+    dst, src = instruction.operands[0], instruction.operands[-1]
+
+    # LD HL,SP+r8
+    if len(instruction.operands) == 3:
+        def op(value):
+            val = regs.SP
+            # HL = SP + r8
+            regs.set16(H, L, val + ((value ^ 0x80) - 0x80))
+            # Flags
+            r[F] = ((val & 0xF) + (value & 0xF) > 0xF) << 5 | ((val & 0xFF) + (value & 0xFF) > 0xFF) << 4
+            return cycles
+        return op
+
+    # LD (a16),SP
+    if dst.name == "a16" and src.name == "SP":
+        def op(value):
+            write16(value, regs.SP)
+            return cycles
+        return op
+
+    # (a8) and (a16) accesses, the bus access happens after the operand fetch
+    if dst.name in ("a8", "a16"):
+        offset = 0xFF00 if dst.name == "a8" else 0
+        fetch = 4 if dst.name == "a8" else 8
+
+        def op(value):
+            cpu.cycles += fetch
+            write8(value + offset, r[A])
+            return cycles
+        return op
+    if src.name in ("a8", "a16"):
+        offset = 0xFF00 if src.name == "a8" else 0
+        fetch = 4 if src.name == "a8" else 8
+
+        def op(value):
+            cpu.cycles += fetch
+            r[A] = read8(value + offset)
+            return cycles
+        return op
+
+    # (C) accesses
+    if dst.name == "C" and not dst.immediate:
+        def op(value):
+            write8(r[C] + 0xFF00, r[A])
+            return cycles
+        return op
+    if src.name == "C" and not src.immediate:
+        def op(value):
+            r[A] = read8(r[C] + 0xFF00)
+            return cycles
+        return op
+
+    # Immediate values
+    if src.bytes is not None:
+        name = dst.name
+        if name in REGISTERS_8:
+            slot = REGISTERS_8[name]
+
+            def op(value):
+                r[slot] = value
+                return cycles
+        elif name == "SP":
+            def op(value):
+                regs.SP = value
+                return cycles
+        elif dst.immediate:
+            hi, lo = REGISTERS_16[name]
+
+            def op(value):
+                r[hi] = value >> 8
+                r[lo] = value & 0xFF
+                return cycles
+        else:
+            # LD (HL),d8
+            def op(value):
+                ptr = r[H] << 8 | r[L]
+                cpu.cycles += 4
+                write8(ptr, value)
+                return cycles
+        return op
+
+    # Register pair pointers, with HL+/HL- adjust
+    if not dst.immediate:
+        hi, lo = REGISTERS_16[dst.name]
+        slot = REGISTERS_8[src.name]
+        step = {"+": 1, "-": -1, None: 0}[dst.adjust]
+        if step:
+            def op(value):
+                ptr = r[hi] << 8 | r[lo]
+                write8(ptr, r[slot])
+                regs.set16(hi, lo, ptr + step)
+                return cycles
+        else:
+            def op(value):
+                write8(r[hi] << 8 | r[lo], r[slot])
+                return cycles
+        return op
+    if not src.immediate:
+        hi, lo = REGISTERS_16[src.name]
+        slot = REGISTERS_8[dst.name]
+        step = {"+": 1, "-": -1, None: 0}[src.adjust]
+        if step:
+            def op(value):
+                ptr = r[hi] << 8 | r[lo]
+                r[slot] = read8(ptr)
+                regs.set16(hi, lo, ptr + step)
+                return cycles
+        else:
+            def op(value):
+                r[slot] = read8(r[hi] << 8 | r[lo])
+                return cycles
+        return op
+
+    # Register to register
+    if dst.name == "SP":
+        def op(value):
+            regs.SP = r[H] << 8 | r[L]
+            return cycles
+        return op
+    slot, other = REGISTERS_8[dst.name], REGISTERS_8[src.name]
+
+    def op(value):
+        r[slot] = r[other]
+        return cycles
+    return op
+
+
+def buildCBHandler(cpu, instruction):
+    regs = cpu.registers
+    r = regs.r
+    memory = cpu.decoder.memory
+    read8, write8 = memory.read8, memory.write8
+    mnemonic = instruction.mnemonic
+    operands = instruction.operands
+    cycles = instruction.cycles[0]
+    # target register, (HL) if not an 8 bit register
+    name = operands[-1].name
+    memory = name not in REGISTERS_8
+    slot = REGISTERS_8.get(name)
+
+    if mnemonic == "BIT":
+        mask = 1 << int(operands[0].name)
+
+        def test(reg):
+            # Flags, carry is kept
+            r[F] = r[F] & 0x10 | ((reg & mask) == 0) << 7 | 0x20
+
+        if memory:
+            def op(value):
+                cpu.cycles += 4
+                test(read8(r[H] << 8 | r[L]))
+                return cycles
+        else:
+            def op(value):
+                test(r[slot])
+                return cycles
+        return op
+
+    if mnemonic == "RES" or mnemonic == "SET":
+        bit = 1 << int(operands[0].name)
+        if mnemonic == "RES":
+            def alter(reg):
+                return reg & ~bit & 0xFF
+        else:
+            def alter(reg):
+                return reg | bit
+    elif mnemonic in SHIFTS:
+        shift = SHIFTS[mnemonic]
+
+        def alter(reg):
+            val = shift(r, reg)
+            # Flags
+            r[F] = ((val & 0xFF) == 0) << 7 | (val > 0xFF) << 4
+            return val & 0xFF
+    else:
+        def op(value):
+            raise InstructionError(f"Instruction {instruction} not yet implemented")
+        return op
+
+    if memory:
+        def op(value):
+            cpu.cycles += 4
+            ptr = r[H] << 8 | r[L]
+            val = alter(read8(ptr))
+            cpu.cycles += 4
+            write8(ptr, val)
+            return cycles
+    else:
+        def op(value):
+            r[slot] = alter(r[slot])
+            return cycles
+    return op
@@ -0,0 +1,76 @@
+# Display
+# cython: annotation_typing = False
+# PyGame window: shows the screen buffer and reads the keyboard.
+# Only imported when the emulator is not headless.
+import sys
+import pygame
+
+# Joypad bit of each key
+KEYMAP = {
+    pygame.K_d: 0,  # right
+    pygame.K_a: 1,  # left
+    pygame.K_w: 2,  # up
+    pygame.K_s: 3,  # down
+    pygame.K_o: 4,  # A
+    pygame.K_p: 5,  # B
+    pygame.K_k: 6,  # select
+    pygame.K_l: 7,  # start
+}
+
+
+class Display:
+    def __init__(self):
+        self._screen = pygame.display.set_mode((160 * 2, 144 * 2))
+        pygame.display.set_caption("PyGB")
+        self._screen.fill((0, 0, 0))
+
+        # init pygame screen
+        pygame.init()
+        pygame.display.update()
+        self._last_draw = pygame.time.get_ticks()
+        self.clock = pygame.time.Clock()
+        self.font = pygame.font.SysFont("Arial", 18)
+
+    # counts an emulated frame for the fps
+    def tick(self):
+        self.clock.tick()
+
+    # Here we limit FPS to get better performance
+    def ready(self):
+        current_time = pygame.time.get_ticks()
+        if current_time > self._last_draw + 40:
+            self._last_draw = current_time
+            return True
+        return False
+
+    # shows a 160x144 RGB frame
+    def present(self, buffer):
+        try:
+            main_surface = pygame.image.frombuffer(buffer, (160, 144), "RGB")
+            main_surface = pygame.transform.scale_by(main_surface, 2)
+            self._screen.blit(main_surface, (0, 0))
+
+            # Show fps
+            fps = str(int(self.clock.get_fps()))
+            fps_text = self.font.render(fps, False, pygame.Color("coral"))
+            self._screen.blit(fps_text, (10, 10))
+
+            # update
+            pygame.display.update()
+
+        except BaseException as e:
+            raise Exception(f"Pygame frame error: {repr(e)}")
+
+    # applies the pending key events to joypad, True if one requests the joypad interrupt
+    def pollInput(self, joypad):
+        interrupt = False
+        for event in pygame.event.get():
+            # Handle quit
+            if event.type == pygame.QUIT:
+                pygame.quit()
+                sys.exit(0)
+            elif event.type == pygame.KEYUP or event.type == pygame.KEYDOWN:
+                bit = KEYMAP.get(event.key)
+                if bit is not None and joypad.handleInput(bit, event.type == pygame.KEYUP):
+                    interrupt = True
+        return interrupt
@@ -14,3 +14,5 @@ cdef class Joypad:
     cpdef void setJoypad(self, uint8_t)
     @cython.locals(interrupt=bint)
     cpdef bint handleInput(self, uint8_t, bint)
+    cpdef bytes saveState(self)
+    cpdef void loadState(self, bytes)
@@ -1,3 +1,9 @@
+import struct
+
+# Save state part: value, joypad
+STATE = struct.Struct("<BB")
+# Joypad bit of each button, the bits of self.joypad
+BUTTONS = {"right": 0, "left": 1, "up": 2, "down": 3, "a": 4, "b": 5, "select": 6, "start": 7}
 
 
 class Joypad:
@@ -44,6 +50,12 @@ class Joypad:
         # store
         self.value = value
 
+    def saveState(self):
+        return STATE.pack(self.value, self.joypad)
+
+    def loadState(self, data):
+        self.value, self.joypad = STATE.unpack(data)
+
     # Bit corresponds to the appropriate bit key in self.joypad
     def handleInput(self, bit, updog):
         interrupt = False
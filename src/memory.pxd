@@ -1,28 +1,87 @@
 import cython
 from libc.stdint cimport int64_t, uint8_t, uint16_t, uint32_t, uint64_t
 
+cdef class RTC:
+    cdef uint64_t time
+    cdef uint64_t cycle
+    cdef bint halted
+    cdef bint carry
+    cdef bytearray latched
+    cdef bint latch_ready
+    @cython.locals(seconds=uint64_t)
+    cdef void update(self, uint64_t)
+    @cython.locals(days=uint64_t)
+    cdef bytes registers(self)
+    cdef void latch(self, uint8_t, uint64_t)
+    cdef uint8_t get(self, uint8_t)
+    @cython.locals(days=uint64_t, hours=uint64_t, minutes=uint64_t, seconds=uint64_t)
+    cdef void set(self, uint8_t, uint8_t, uint64_t)
+    cpdef bytes saveState(self)
+    @cython.locals(latched=bytes)
+    cpdef void loadState(self, bytes)
+    cdef bytes saveClock(self, uint64_t)
+    @cython.locals(latched=bytes)
+    cdef void loadClock(self, bytes)
+
 cdef class Memory:
-    cdef uint8_t[0x8000] ram
+    cdef bytearray space
+    cdef public object vram
     cdef uint8_t[128] hram
-    cdef uint8_t[8192] i_ram
     cdef uint8_t[0x10000] junk_rom
-    cdef cartridge
+    cdef int[256] read_pages
+    cdef int[256] write_pages
     cdef uint16_t rom_bank
     cdef uint16_t ram_bank
     cdef bint ram_enabled
     cdef bint rom_enabled
     cdef uint16_t total_ram_banks
+    cdef uint64_t dma_end
+    cdef RTC rtc
+    cdef uint8_t rtc_register
+    cdef int ram_banks
+    cdef int rom_start
+    cdef int save_size
+    cdef object save
+    cdef bytearray ram_dirty
     cdef uint16_t total_rom_banks
     cdef uint16_t bank_bits
     cdef cpu
     cdef int cartridge_type
     cdef uint8_t mbc
-    cdef void sync(self)
-    @cython.locals(temp=uint16_t,offset=cython.int)
-    cdef void set(self, uint16_t, uint8_t)
-    @cython.locals(temp=uint16_t,offset=cython.int)
-    cdef uint16_t get(self, uint16_t, uint8_t counter=*)
-    @cython.locals(temp=uint8_t)
+    cdef list code_cache
+    cdef public bytearray block_map
+    cdef public list idle_reads
+    cdef public bint idle_wrote
+    @cython.locals(page=int)
+    cdef void mapPages(self)
+    cdef int romPage(self, int)
+    @cython.locals(page=int, offset=int)
+    cdef void mapROM(self)
+    @cython.locals(page=int, offset=int)
+    cdef void mapRAM(self)
+    cdef void sync(self, uint16_t)
+    @cython.locals(offset=cython.int)
+    cpdef void write8(self, uint16_t, uint8_t)
+    @cython.locals(offset=cython.int)
+    cpdef void write16(self, uint16_t, uint16_t)
+    cdef void setUnmapped(self, uint16_t, uint8_t)
+    @cython.locals(offset=cython.int)
+    cpdef uint8_t read8(self, uint16_t)
+    @cython.locals(offset=cython.int)
+    cpdef uint16_t read16(self, uint16_t)
+    cdef uint8_t getUnmapped(self, uint16_t)
+    @cython.locals(cache=list)
+    cdef void invalidateCode(self, uint16_t)
+    @cython.locals(temp=uint8_t,bank=uint16_t,ram_bank=uint16_t,ram_enabled=bint,rtc_register=uint8_t)
     cdef void handleROMSet(self, uint16_t, uint8_t)
-    @cython.locals(offset=cython.int,n=cython.int)
+    @cython.locals(size=int)
+    cpdef void openSave(self, object)
+    @cython.locals(changed=bint, clock=bytes)
+    cpdef void storeSave(self)
+    cpdef void closeSave(self)
+    cpdef bytes getRAM(self)
+    cpdef bytes saveState(self)
+    @cython.locals(bank=uint16_t, offset=int, part=bytes)
+    cpdef void loadState(self, bytes)
+    @cython.locals(offset=cython.int, n=cython.int, data=bytes)
     cdef void dma(self, uint8_t)
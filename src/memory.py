@@ -1,24 +1,64 @@
-import sys
+import atexit
+import struct
 # from cpu import CPU
+from battery import BATTERY_TYPES, SaveFile
 from cartridge import CartridgeMetadata
+
+# Save state part: rom bank, ram bank, ram enabled, rom enabled, end of the oam dma, selected clock register,
+# then the internal ram, video ram and cartridge ram, hram, the unimplemented io registers and the clock
+STATE = struct.Struct("<HH??QB")
+# range of junk_rom that can be written, the unimplemented io registers
+JUNK_START, JUNK_END = 0xFEA0, 0xFF80
+# offsets in the backing store of the mapped pages: internal ram, video ram, cartridge ram (at least 4 banks),
+# then the rom
+WORK_RAM, VIDEO_RAM, CART_RAM = 0, 0x2000, 0x4000
+# page without a backing buffer, accessed through getUnmapped and setUnmapped
+UNMAPPED = -1
+# cycles of an oam dma, 160 M-cycles
+DMA_CYCLES = 640
+# Clock save state part: seconds, cycle they were counted to, halted, day carry, latched registers, latch armed
+RTC_STATE = struct.Struct("<QQ??5s?")
+# Clock kept after the cartridge ram in the save file: seconds, halted, day carry, latched registers
+RTC_SAVE = struct.Struct("<Q??5s")
+CYCLES_PER_SECOND = 4194304
+SECONDS_PER_DAY = 86400
+
+
 class Memory:
     def __init__(self, cartridge, cartridge_metadata: CartridgeMetadata , cpu):
         # TODO: fix ram
-        self.ram = [0] * 0x8000  # cartridge ram, including banks (up to 4)
-        self.hram = [0] * 128 # internal hram
-        self.i_ram = [0] * 8192 # 8kb internal ram
-        self.junk_rom = [0] * 0x10000 # all unimplemented features are stored here
-        self.cartridge = cartridge
+        self.hram = bytearray(128) # internal hram
+        self.junk_rom = bytearray(0x10000) # all unimplemented features are stored here
         self.rom_bank = 1  # rom banks for cartridge
         self.ram_bank = 0  # current ram bank
         self.ram_enabled = False
         self.rom_enabled = True
         self.total_ram_banks = 0
+        # cycle the running oam dma ends at, the cpu can't access oam until then
+        self.dma_end = 0
+        # mbc3 clock and its register mapped to 0xA000-0xBFFF (0x08-0x0C), 0 when ram is
+        self.rtc = None
+        self.rtc_register = 0
+        # save file of battery backed ram, set by openSave, and the 256 byte pages of ram written since the last store
+        self.save = None
+        self.ram_dirty = None
+
+        # offset in space of each 256 byte page for reads and writes, or UNMAPPED
+        self.read_pages = [UNMAPPED] * 256
+        self.write_pages = [UNMAPPED] * 256
+
+        # decoded instruction cache for ram, set by the decoder
+        self.code_cache = None
+        # ram bytes translated into blocks, set by the translator
+        self.block_map = None
+        # addresses read and whether anything was written, logged while the cpu watches an idle loop
+        self.idle_reads = None
+        self.idle_wrote = False
 
         # needs access to cpu
         self.cpu = cpu
 
-        cartridge_type = cartridge_metadata.cartridge_type
+        cartridge_type = self.cartridge_type = cartridge_metadata.cartridge_type
         ram_size = cartridge_metadata.ram_size
         rom_size = cartridge_metadata.rom_size
 
@@ -29,6 +69,11 @@ class Memory:
             self.mbc = 1
         elif 5 <= cartridge_type <= 6:
             self.mbc = 2
+        elif 0x0F <= cartridge_type <= 0x13:
+            self.mbc = 3
+            self.rtc = RTC()
+        elif 0x19 <= cartridge_type <= 0x1E:
+            self.mbc = 5
         else:
             raise ValueError(f"Unimplemented Cartridge Type of value: {cartridge_type}")
 
@@ -42,56 +87,135 @@ class Memory:
         elif ram_size == 5:
             self.total_ram_banks = 8
 
+        # bytes of ram kept by the battery, mbc2 has 512 (4 bit) bytes built in
+        if self.mbc == 2:
+            self.save_size = 0x200
+        elif ram_size == 1:
+            self.save_size = 0x800
+        else:
+            self.save_size = self.total_ram_banks * 0x2000
+
         # set ROM size
         self.total_rom_banks = 2**(rom_size + 1)
         self.bank_bits = (1 << (rom_size + 1)) - 1
 
-    def sync(self):
-        # Timer tick
-        if self.cpu.timer.tick(self.cpu.cycles):
-            self.cpu.setInterrupt(2)
-
-        # Screen tick
-        self.cpu.screen.update(self.cpu.cycles)
-
-        # Sync
-        self.cpu.sync_cycles += self.cpu.cycles
-
-        # Reset
-        self.cpu.cycles = 0
+        # one bytearray backs the internal ram, video ram, cartridge ram and rom, the rom is copied in once.
+        # The rom is padded with zeros to whole pages, so a last partial page is mapped too
+        self.ram_banks = max(self.total_ram_banks, 4)
+        self.rom_start = CART_RAM + self.ram_banks * 0x2000
+        self.space = bytearray(self.rom_start + ((len(cartridge) + 0xFF) & ~0xFF))
+        # through a memoryview, a bytearray slice assignment would copy the rom to a temporary first
+        view = memoryview(self.space)
+        view[self.rom_start:self.rom_start + len(cartridge)] = cartridge
+        # video ram, shared with the screen
+        self.vram = view[VIDEO_RAM:VIDEO_RAM + 0x2000]
+
+        self.mapPages()
+
+    # pages of rom bank 0, video ram, internal ram and its echo, then the banked rom and cartridge ram
+    def mapPages(self):
+        for page in range(0x40):
+            self.read_pages[page] = self.romPage(page << 8)
+        for page in range(0x80, 0xA0):
+            self.read_pages[page] = VIDEO_RAM + ((page - 0x80) << 8)
+        for page in range(0xC0, 0xE0):
+            self.read_pages[page] = self.write_pages[page] = WORK_RAM + ((page - 0xC0) << 8)
+        # echo ram reads, writes go through setUnmapped to invalidate code at the internal ram address
+        for page in range(0xE0, 0xFE):
+            self.read_pages[page] = WORK_RAM + ((page - 0xE0) << 8)
+        self.mapROM()
+        self.mapRAM()
+
+    # offset in space of the rom page at offset, UNMAPPED past the end of the (padded) rom
+    def romPage(self, offset):
+        offset += self.rom_start
+        if offset + 0x100 > len(self.space):
+            return UNMAPPED
+        return offset
+
+    # points 0x4000-0x7FFF at the current rom bank
+    def mapROM(self):
+        offset = self.rom_bank * 0x4000
+        for page in range(0x40, 0x80):
+            self.read_pages[page] = self.romPage(offset)
+            offset += 0x100
+
+    # points 0xA000-0xBFFF at the current ram bank, disabled ram and the clock registers go through
+    # the unmapped accessors
+    def mapRAM(self):
+        # banks past the ones kept wrap around
+        offset = CART_RAM + (self.ram_bank % self.ram_banks) * 0x2000
+        for page in range(0xA0, 0xC0):
+            if self.ram_enabled and not self.rtc_register:
+                self.read_pages[page] = self.write_pages[page] = offset
+            else:
+                self.read_pages[page] = self.write_pages[page] = UNMAPPED
+            offset += 0x100
 
-    def set(self, address, value):
-        if address < 0:
-            raise ValueError(f"Trying to write negative address {hex(address)} (value:{value})")
+    # the timer and screen run behind the cpu, catch them up before touching vram, oam or io
+    def sync(self, address):
+        if 0x8000 <= address < 0xA000 or 0xFE00 <= address < 0xFF80:
+            self.cpu.sync()
 
-        if value is None:
-            raise ValueError(f"Trying to write None to {hex(address)}")
+    def write8(self, address, value):
         value &= 0xFF
-        self.sync()
+        if self.idle_reads is not None:
+            self.idle_wrote = True
+        offset = self.write_pages[address >> 8]
+        if offset == UNMAPPED:
+            self.setUnmapped(address, value)
+            return
+        self.space[offset + (address & 0xFF)] = value
+        # internal ram may hold code
+        if address >= 0xC000:
+            self.invalidateCode(address)
+        # cartridge ram, stored to the save file later
+        elif self.ram_dirty is not None:
+            self.ram_dirty[(offset - CART_RAM) >> 8] = 1
+
+    # low byte first, split in two writes across a page or outside the mapped pages
+    def write16(self, address, value):
+        offset = self.write_pages[address >> 8]
+        if offset == UNMAPPED or address & 0xFF == 0xFF or self.idle_reads is not None:
+            self.write8(address, value & 0xFF)
+            self.write8((address + 1) & 0xFFFF, value >> 8)
+            return
+        offset += address & 0xFF
+        self.space[offset] = value & 0xFF
+        self.space[offset + 1] = (value >> 8) & 0xFF
+        if address >= 0xC000:
+            self.invalidateCode(address)
+            self.invalidateCode(address + 1)
+        elif self.ram_dirty is not None:
+            self.ram_dirty[(offset - CART_RAM) >> 8] = 1
+
+    # writes to rom (mbc registers), video ram, disabled cartridge ram, echo ram, oam and io
+    def setUnmapped(self, address, value):
+        # Internal HRAM, checked first as stacks and variables often live there
+        if 0xFF80 <= address < 0xFFFF:
+            self.hram[address - 0xFF80] = value
+            self.invalidateCode(address)
+            return
+        self.sync(address)
         if address < 0x8000:
             self.handleROMSet(address, value)
 
         elif 0x8000 <= address < 0xA000:
             self.cpu.screen.screenSet(address, value)
 
-        # writing to RAM
+        # clock registers or disabled cartridge ram
         elif 0xA000 <= address < 0xC000:
-            if self.ram_enabled:
-                temp = address - 0xA000
-                offset = self.ram_bank * 0x2000
-                self.ram[temp + offset] = value
-
-        # internal ram
-        elif 0xC000 <= address < 0xE000:
-            self.i_ram[address - 0xC000] = value
+            if self.rtc_register and self.ram_enabled:
+                self.rtc.set(self.rtc_register, value, self.cpu.total_cycles + self.cpu.cycles)
 
         # echo ram
         elif 0xE000 <= address < 0xFE00:
-            self.set(address - 0x2000, value)
+            self.write8(address - 0x2000, value)
 
-        # OAM
+        # OAM, unless a dma is running
         elif 0xFE00 <= address < 0xFEA0:
-            self.cpu.screen.screenSet(address, value)
+            if self.cpu.scheduler.now >= self.dma_end:
+                self.cpu.screen.screenSet(address, value)
 
         # Joypad
         elif address == 0xFF00:
@@ -111,10 +235,6 @@ class Memory:
             else:
                 self.cpu.screen.screenSet(address, value)
 
-        # Internal HRAM
-        elif 0xFF80 <= address < 0xFFFF:
-            self.hram[address - 0xFF80] = value
-
         # Interrupt enable register
         elif address == 0xFFFF:
             # print(f"writing {bin(value)} to cpu.i_enable")
@@ -123,49 +243,42 @@ class Memory:
         else:
             self.junk_rom[address] = value
 
-    def get(self, address, counter = 1):
-        if address < 0:
-            raise ValueError(f"Trying to read negative address {hex(address)}")
-        self.sync()
-        # Cartridge ROM
-        if address < 0x4000:
-            data = self.cartridge[address: address + counter]
-            return int.from_bytes(data, sys.byteorder)
-
-        # Cartridge ROM with memory map
-        elif 0x4000 <= address < 0x8000:
-            temp = address - 0x4000
-            offset = self.rom_bank * 0x4000
-            data = self.cartridge[temp + offset: temp + offset + counter]
-            return int.from_bytes(data, sys.byteorder)
-
-        # 8kB Video RAM
-        elif 0x8000 <= address < 0xA000:
-            return self.cpu.screen.screenGet(address, counter)
+    def read8(self, address):
+        if self.idle_reads is not None:
+            self.idle_reads.append(address)
+        offset = self.read_pages[address >> 8]
+        if offset == UNMAPPED:
+            return self.getUnmapped(address)
+        return self.space[offset + (address & 0xFF)]
+
+    # little endian, split in two reads across a page or outside the mapped pages
+    def read16(self, address):
+        offset = self.read_pages[address >> 8]
+        if offset == UNMAPPED or address & 0xFF == 0xFF or self.idle_reads is not None:
+            return self.read8(address) | self.read8((address + 1) & 0xFFFF) << 8
+        offset += address & 0xFF
+        return self.space[offset] | self.space[offset + 1] << 8
+
+    # reads of rom past its end, disabled cartridge ram, oam and io
+    def getUnmapped(self, address):
+        # Internal HRAM, checked first as stacks and variables often live there
+        if 0xFF80 <= address < 0xFFFF:
+            return self.hram[address - 0xFF80]
+        self.sync(address)
+        if address < 0x8000:
+            return 0
 
-        # cartridge RAM access
+        # clock registers or disabled cartridge ram
         elif 0xA000 <= address < 0xC000:
-            if not self.ram_enabled:
-                return 0xFF
-            temp = address - 0xA000
-            offset = self.ram_bank * 0x2000
-            data = self.ram[temp + offset: temp + offset + counter]
-            return int.from_bytes(data, sys.byteorder)
-
-        # internal ram access
-        elif 0xC000 <= address < 0xE000:
-            temp = address - 0xC000
-            data = self.i_ram[temp : temp + counter]
-            return int.from_bytes(data, sys.byteorder)
-
-        # echo internal ram
-        elif 0xE000 <= address < 0xFE00:
-            # Redirect to internal RAM
-            return self.get(address - 0x2000, counter)
+            if self.rtc_register and self.ram_enabled:
+                return self.rtc.get(self.rtc_register)
+            return 0xFF
 
-        # OAM
+        # OAM, reads 0xFF while a dma is running
         elif 0xFE00 <= address < 0xFEA0:
-            return self.cpu.screen.screenGet(address, counter)
+            if self.cpu.scheduler.now < self.dma_end:
+                return 0xFF
+            return self.cpu.screen.screenGet(address)
 
         # Joypad
         elif address == 0xFF00:
@@ -183,24 +296,31 @@ class Memory:
         elif 0xFF40 <= address <= 0xFF4B:
             return self.cpu.screen.screenGet(address)
 
-        # Internal HRAM
-        elif 0xFF80 <= address < 0xFFFF:
-            temp = address - 0xFF80
-            data = self.hram[temp : temp + counter]
-            return int.from_bytes(data, sys.byteorder)
-
         # Interrupt enable register
         elif address == 0xFFFF:
             return self.cpu.i_enable
 
         # return values for unimplemented stuff
         else:
-            data = self.junk_rom[address : address + counter]
-            return int.from_bytes(data, sys.byteorder)
+            return self.junk_rom[address]
+
+    # drops the decoded instructions that may contain the byte at address
+    def invalidateCode(self, address):
+        cache = self.code_cache
+        if cache is not None:
+            cache[address] = 0
+            cache[address - 1] = 0
+            cache[address - 2] = 0
+        if self.block_map is not None and self.block_map[address]:
+            self.cpu.translator.invalidate(address)
 
     # handles writing to address < 0x8000, usually associated with ROM and RAM settings
-    # only mbc1 and mbc2 so far
+    # mbc1, mbc2, mbc3 and mbc5
     def handleROMSet(self, address, value):
+        bank = self.rom_bank
+        ram_bank = self.ram_bank
+        ram_enabled = self.ram_enabled
+        rtc_register = self.rtc_register
         # mbc1
         if self.mbc == 1:
             # ram control
@@ -245,8 +365,8 @@ class Memory:
                 self.rom_enabled = (value & 0b1) == 0
                 if self.rom_enabled:
                     self.ram_bank = 0
-            # mbc2
-        if self.mbc == 2:
+        # mbc2
+        elif self.mbc == 2:
             if address < 0x4000:
                 temp = value & 0b00001111
                 if (address & 0x100) == 0:
@@ -258,9 +378,220 @@ class Memory:
                     if temp == 0:
                         temp = 1
                     self.rom_bank = temp
-
+        # mbc3
+        elif self.mbc == 3:
+            # ram and clock control
+            if address < 0x2000:
+                self.ram_enabled = (value & 0b00001111) == 0xA
+            # 7 bit rom bank, 0 selects 1
+            elif address < 0x4000:
+                temp = value & 0b01111111
+                if temp == 0:
+                    temp = 1
+                self.rom_bank = temp & self.bank_bits
+            # ram bank, or a clock register
+            elif address < 0x6000:
+                if 0x08 <= value <= 0x0C:
+                    self.rtc_register = value
+                else:
+                    self.rtc_register = 0
+                    self.ram_bank = value & 0b11
+            # writing 0 then 1 latches the clock
+            else:
+                self.rtc.latch(value, self.cpu.total_cycles + self.cpu.cycles)
+        # mbc5
+        elif self.mbc == 5:
+            if address < 0x2000:
+                self.ram_enabled = (value & 0b00001111) == 0xA
+            # low 8 bits of the 9 bit rom bank, bank 0 can be selected
+            elif address < 0x3000:
+                self.rom_bank = (self.rom_bank & 0x100 | value) & self.bank_bits
+            # bit 8 of the rom bank
+            elif address < 0x4000:
+                self.rom_bank = (self.rom_bank & 0xFF | (value & 1) << 8) & self.bank_bits
+            elif address < 0x6000:
+                self.ram_bank = value & 0b00001111
+
+        # switch the pages and the decoded instruction and block caches along with the bank
+        if self.rom_bank != bank:
+            self.mapROM()
+            self.cpu.decoder.selectBank(self.rom_bank)
+            if self.cpu.translator is not None:
+                self.cpu.translator.selectBank(self.rom_bank)
+        if self.ram_bank != ram_bank or self.ram_enabled != ram_enabled or self.rtc_register != rtc_register:
+            self.mapRAM()
+        # games disable the ram when they are done writing it
+        if ram_enabled and not self.ram_enabled:
+            self.storeSave()
+
+    # maps the save file at path for battery backed cartridges and loads the ram and the clock from it
+    def openSave(self, path):
+        if self.cartridge_type not in BATTERY_TYPES or not self.save_size and self.rtc is None:
+            return
+        # the clock is kept after the ram
+        size = self.save_size + (RTC_SAVE.size if self.rtc is not None else 0)
+        self.save = SaveFile(path, size)
+        # copied rather than mapped, the page tables only point into space
+        memoryview(self.space)[CART_RAM:CART_RAM + self.save_size] = self.save.map[0:self.save_size]
+        if self.rtc is not None:
+            self.rtc.loadClock(self.save.map[self.save_size:size])
+        self.ram_dirty = bytearray(self.ram_banks * 0x20)
+        atexit.register(self.closeSave)
+
+    # copies the ram written since the last store and the clock into the save file
+    def storeSave(self):
+        if self.save is None:
+            return
+        changed = 1 in self.ram_dirty
+        if self.rtc is not None:
+            clock = self.rtc.saveClock(self.cpu.total_cycles + self.cpu.cycles)
+            if self.save.map[self.save_size:self.save_size + RTC_SAVE.size] != clock:
+                self.save.map[self.save_size:self.save_size + RTC_SAVE.size] = clock
+                changed = True
+        if not changed:
+            return
+        self.save.store(memoryview(self.space)[CART_RAM:CART_RAM + self.save_size], self.ram_dirty)
+        self.ram_dirty[0:len(self.ram_dirty)] = bytes(len(self.ram_dirty))
+
+    def closeSave(self):
+        if self.save is not None:
+            self.storeSave()
+            self.save.close()
+            # closed once, also when called again at exit
+            self.save = None
+
+    # copy of the internal ram (0xC000-0xDFFF) and the 128 bytes of hram from 0xFF80
+    def getRAM(self):
+        # sliced, a whole uint8_t array would convert to bytes up to the first 0 when compiled
+        return bytes(self.space[WORK_RAM:WORK_RAM + 0x2000]) + bytes(self.hram[0:128])
+
+    def saveState(self):
+        return (STATE.pack(self.rom_bank, self.ram_bank, self.ram_enabled, self.rom_enabled, self.dma_end,
+                           self.rtc_register)
+                + bytes(self.space[0:self.rom_start]) + bytes(self.hram[0:128])
+                + bytes(self.junk_rom[JUNK_START:JUNK_END])
+                + (self.rtc.saveState() if self.rtc is not None else b""))
+
+    # data is bytes, the part written by saveState
+    def loadState(self, data):
+        bank = self.rom_bank
+        (self.rom_bank, self.ram_bank, self.ram_enabled, self.rom_enabled, self.dma_end,
+         self.rtc_register) = STATE.unpack_from(data)
+        offset = STATE.size
+        # each slice is held in part, the arrays are copied from it
+        part = data[offset : offset + self.rom_start]
+        self.space[0:self.rom_start] = part
+        offset += self.rom_start
+        part = data[offset : offset + 128]
+        self.hram[0:128] = part
+        offset += 128
+        part = data[offset : offset + JUNK_END - JUNK_START]
+        self.junk_rom[JUNK_START:JUNK_END] = part
+        offset += JUNK_END - JUNK_START
+        if self.rtc is not None:
+            self.rtc.loadState(data[offset:])
+        # the loaded ram goes to the save file on the next store
+        if self.ram_dirty is not None:
+            self.ram_dirty[0:len(self.ram_dirty)] = b"\x01" * len(self.ram_dirty)
+        self.mapROM()
+        self.mapRAM()
+        if self.rom_bank != bank:
+            self.cpu.decoder.selectBank(self.rom_bank)
+            if self.cpu.translator is not None:
+                self.cpu.translator.selectBank(self.rom_bank)
+
+    # copies the 160 bytes from value * 0x100 to oam at once. The cpu keeps running during the transfer,
+    # only its oam accesses wait for the end, so the time is kept as the cycle the dma ends at
     def dma(self, value):
-        offset = value * 0x100
-        for n in range(0xA0):
-            self.set(0xFE00 + n, self.get(n + offset))
-
+        offset = self.read_pages[value]
+        if offset == UNMAPPED:
+            data = bytes([self.getUnmapped(value << 8 | n) for n in range(0xA0)])
+        else:
+            data = bytes(self.space[offset : offset + 0xA0])
+        self.cpu.screen.setOAM(data)
+        self.dma_end = self.cpu.scheduler.now + DMA_CYCLES
+
+
+# MBC3 real time clock. It counts emulated time, so runs and save states stay deterministic.
+# Registers 0x08-0x0C: seconds, minutes, hours, low 8 bits of the day and the day high register
+# (bit 0 day bit 8, bit 6 halt, bit 7 day carry). The cpu reads the copy made by the last latch.
+class RTC:
+    def __init__(self):
+        # seconds counted, days included, and the cycle they are counted up to
+        self.time = 0
+        self.cycle = 0
+        self.halted = False
+        self.carry = False
+        self.latched = bytearray(5)
+        # a 0 was written to the latch register, a 1 next latches
+        self.latch_ready = False
+
+    # counts the whole seconds passed until now
+    def update(self, now):
+        if self.halted:
+            self.cycle = now
+            return
+        seconds = (now - self.cycle) // CYCLES_PER_SECOND
+        if seconds:
+            self.cycle += seconds * CYCLES_PER_SECOND
+            self.time += seconds
+            # the day counter has 9 bits
+            if self.time >= 512 * SECONDS_PER_DAY:
+                self.time %= 512 * SECONDS_PER_DAY
+                self.carry = True
+
+    def registers(self):
+        days = self.time // SECONDS_PER_DAY
+        return bytes((self.time % 60, self.time // 60 % 60, self.time // 3600 % 24, days & 0xFF,
+                      days >> 8 | self.halted << 6 | self.carry << 7))
+
+    def latch(self, value, now):
+        if self.latch_ready and value == 1:
+            self.update(now)
+            self.latched[0:5] = self.registers()
+        self.latch_ready = value == 0
+
+    def get(self, register):
+        return self.latched[register - 0x08]
+
+    def set(self, register, value, now):
+        self.update(now)
+        days = self.time // SECONDS_PER_DAY
+        hours = self.time // 3600 % 24
+        minutes = self.time // 60 % 60
+        seconds = self.time % 60
+        if register == 0x08:
+            seconds = value % 60
+            # the second starts over
+            self.cycle = now
+        elif register == 0x09:
+            minutes = value % 60
+        elif register == 0x0A:
+            hours = value % 24
+        elif register == 0x0B:
+            days = days & 0x100 | value
+        else:
+            days = days & 0xFF | (value & 1) << 8
+            self.halted = (value & 0x40) != 0
+            self.carry = (value & 0x80) != 0
+        self.time = days * SECONDS_PER_DAY + hours * 3600 + minutes * 60 + seconds
+
+    def saveState(self):
+        return RTC_STATE.pack(self.time, self.cycle, self.halted, self.carry, bytes(self.latched),
+                              self.latch_ready)
+
+    def loadState(self, data):
+        self.time, self.cycle, self.halted, self.carry, latched, self.latch_ready = RTC_STATE.unpack(data)
+        self.latched[0:5] = latched
+
+    # the clock kept in the save file, with the seconds counted up to now
+    def saveClock(self, now):
+        self.update(now)
+        return RTC_SAVE.pack(self.time, self.halted, self.carry, bytes(self.latched))
+
+    # data is the part written by saveClock. The save file is opened before the cpu runs, so the clock
+    # counts on from cycle 0, a second started when it was stored is lost
+    def loadClock(self, data):
+        self.time, self.halted, self.carry, latched = RTC_SAVE.unpack(data)
+        self.latched[0:5] = latched
+        self.cycle = 0
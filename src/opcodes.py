@@ -1,8 +1,12 @@
 from __future__ import annotations
 from dataclasses import dataclass
 from typing import Literal
+from pathlib import Path
+import hashlib
 import json
 import copy
+import os
+import struct
 
 
 # Operand class
@@ -23,16 +27,19 @@ class Operand:
     def copy(self):
         return copy.copy(self)
 
-    def print(self):
+    # value is the decoded immediate, shown for operands read from the instruction bytes
+    def print(self, value=None):
         if self.adjust is None:
             adjust = ""
         else:
             adjust = self.adjust
-        if self.value is not None:
+        if value is None or self.bytes is None:
+            value = self.value
+        if value is not None:
             if self.bytes is not None:
-                val = hex(self.value)
+                val = hex(value)
             else:
-                val = self.value
+                val = value
             v = val
         else:
             v = self.name
@@ -65,18 +72,95 @@ class Instruction:
     def copy(self):
         return copy.copy(self)
 
-    def print(self):
-        ops = ', '.join(op.print() for op in self.operands)
+    def print(self, value=None):
+        ops = ', '.join(op.print(value) for op in self.operands)
         s = f"{hex(self.opcode)} {self.mnemonic:<8} {ops}"
         return s
 
 
+# Opcode table cache, written next to the json on the first run (or by setup.py)
+# and used while the sha1 of the json matches
+CACHE_MAGIC = b"PYGBOPS1"
+# magic, sha1 of the json, unprefixed and cb prefixed counts, length of the names
+CACHE_HEADER = struct.Struct("<8s20sHHH")
+# opcode, immediate, bytes, mnemonic, cycle count, 2 cycles, operand count,
+# then 3 operands of immediate, bytes, adjust, name
+CACHE_RECORD = struct.Struct("<20B")
+ADJUSTS = (None, "+", "-")
+
+
 # Returns unprefixed and cbprefixed opcodes dictionary
 def getOpcodes(filename):
-    # Open instructions
-    f = open(filename)
-    instructions = json.load(f)
-
+    data = Path(filename).read_bytes()
+    digest = hashlib.sha1(data).digest()
+    cachefile = Path(filename).with_suffix(".cache")
+    try:
+        tables = loadCache(cachefile, digest)
+    except (OSError, ValueError, struct.error):
+        tables = None
+    if tables is None:
+        tables = parseOpcodes(json.loads(data))
+        try:
+            saveCache(cachefile, digest, *tables)
+        except OSError:
+            pass
+    return tables
+
+
+# Reads the tables from the cache, None if it was made from another json
+def loadCache(cachefile, digest):
+    blob = cachefile.read_bytes()
+    magic, cache_digest, unprefixed_count, cbprefixed_count, names_length = CACHE_HEADER.unpack_from(blob)
+    if magic != CACHE_MAGIC or cache_digest != digest:
+        return None
+    start = CACHE_HEADER.size
+    names = blob[start : start + names_length].decode().split("\n")
+    instructions = []
+    # equal operands are shared, the tables are never modified
+    operands = {}
+    for record in CACHE_RECORD.iter_unpack(blob[start + names_length :]):
+        oplist = []
+        for i in range(8, 8 + 4 * record[7], 4):
+            key = record[i : i + 4]
+            operand = operands.get(key)
+            if operand is None:
+                immediate, size, adjust, name = key
+                operand = Operand(immediate=bool(immediate), name=names[name], bytes=size or None, value=None,
+                                  adjust=ADJUSTS[adjust])
+                operands[key] = operand
+            oplist.append(operand)
+        instructions.append(
+            Instruction(opcode=record[0], immediate=bool(record[1]), bytes=record[2], cycles=list(record[5 : 5 + record[4]]),
+                        mnemonic=names[record[3]], operands=oplist))
+    if len(instructions) != unprefixed_count + cbprefixed_count:
+        raise ValueError("Truncated opcode cache")
+    return instructions[:unprefixed_count], instructions[unprefixed_count:]
+
+
+# Writes the tables to the cache
+def saveCache(cachefile, digest, unprefixed, cbprefixed):
+    names = {}
+    records = []
+    for instruction in unprefixed + cbprefixed:
+        record = [instruction.opcode, instruction.immediate, instruction.bytes,
+                  names.setdefault(instruction.mnemonic, len(names)), len(instruction.cycles)]
+        record += (instruction.cycles + [0])[:2]
+        record.append(len(instruction.operands))
+        for operand in instruction.operands:
+            record += [operand.immediate, operand.bytes or 0, ADJUSTS.index(operand.adjust),
+                       names.setdefault(operand.name, len(names))]
+        record += [0] * (CACHE_RECORD.size - len(record))
+        records.append(CACHE_RECORD.pack(*record))
+    table = "\n".join(names).encode()
+    header = CACHE_HEADER.pack(CACHE_MAGIC, digest, len(unprefixed), len(cbprefixed), len(table))
+    # write then rename, so a concurrent start never reads half a cache
+    temp = cachefile.with_suffix(f".{os.getpid()}.tmp")
+    temp.write_bytes(header + table + b"".join(records))
+    os.replace(temp, cachefile)
+
+
+# Builds the unprefixed and cbprefixed instruction lists from the parsed json
+def parseOpcodes(instructions):
     # Initialize instruction list
     unprefixed = []
     cbprefixed = []
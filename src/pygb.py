@@ -1,20 +1,20 @@
 from cartridge import get_cartridge_metadata
 from cpu import CPU
-import sys
+import argparse
 import os
-if len(sys.argv) > 2:
-    raise AssertionError(f"Only path to rom argument is allowed")
 
-if len(sys.argv) == 1:
-    filename = "../test roms/super mario.gb"
-else:
-    filename = sys.argv[1]
+parser = argparse.ArgumentParser(description="PyGB Game Boy emulator")
+parser.add_argument("rom", nargs="?", default="../test roms/super mario.gb", help="path to rom")
+parser.add_argument("--headless", action="store_true", help="run without a window, pygame is not imported")
+parser.add_argument("--no-save", action="store_true", help="don't keep battery backed ram in a .sav file next to the rom")
+args = parser.parse_args()
 
+filename = args.rom
 if not os.path.isfile(filename):
     raise AssertionError(f"Rom path {filename} does not exist")
 
 metadata = get_cartridge_metadata(filename)
-cpu = CPU(filename, metadata)
+cpu = CPU(filename, metadata, headless=args.headless, save_ram=not args.no_save)
 cpu.initVals()
 cpu.run()
 
@@ -1,81 +1,126 @@
 # Registers
 # cython: annotation_typing = False
-# from collections.abc import MutableMapping
-from dataclasses import dataclass
 import cython
 
 
+# Slots of the 8 bit registers, in the order the opcodes encode them (slot 6, (HL) in the opcodes, holds F)
+B, C, D, E, H, L, F, A = range(8)
+
 # Constants
-REGISTERS_LOW = {"F": "AF", "C": "BC", "E": "DE", "L": "HL"}
-REGISTERS_HIGH = {"A": "AF", "B": "BC", "D": "DE", "H": "HL"}
-REGISTERS = {"AF", "BC", "DE", "HL", "PC", "SP"}
+REGISTERS_8 = {"B": B, "C": C, "D": D, "E": E, "H": H, "L": L, "F": F, "A": A}
+REGISTERS_16 = {"AF": (A, F), "BC": (B, C), "DE": (D, E), "HL": (H, L)}
 FLAGS = {"c": 4, "h": 5, "n": 6, "z": 7}
+# Flag masks in F
+FLAG_Z, FLAG_N, FLAG_H, FLAG_C = 0x80, 0x40, 0x20, 0x10
+
 
-@dataclass
 @cython.cclass
 class Registers:
-    AF: cython.int
-    BC: cython.int
-    DE: cython.int
-    HL: cython.int
-    PC: cython.int
-    SP: cython.int
-
-    # def values(self):
-    #     return [self.AF, self.BC, self.DE, self.HL, self.PC, self.SP]
-    #
-    # def __iter__(self):
-    #     return iter(self.values())
-    #
-    # def __len__(self):
-    #     return len(self.values())
-
-    @cython.cfunc
+    # 8 bit registers by slot
+    r = cython.declare(list, visibility="public")
+    SP = cython.declare(cython.int, visibility="public")
+    PC = cython.declare(cython.int, visibility="public")
+
+    def __init__(self, AF=0, BC=0, DE=0, HL=0, PC=0, SP=0):
+        self.r = [0] * 8
+        self.set16(A, F, AF)
+        self.set16(B, C, BC)
+        self.set16(D, E, DE)
+        self.set16(H, L, HL)
+        self.SP = SP & 0xFFFF
+        self.PC = PC & 0xFFFF
+
+    # 16 bit pair of slots hi, lo
+    @cython.ccall
+    def get16(self, hi, lo):
+        return self.r[hi] << 8 | self.r[lo]
+
+    @cython.ccall
+    def set16(self, hi, lo, value):
+        value &= 0xFFFF
+        self.r[hi] = value >> 8
+        self.r[lo] = value & 0xFF
+
+    # flag by mask (FLAG_Z...)
+    @cython.ccall
+    def flag(self, mask):
+        return 1 if self.r[F] & mask else 0
+
+    @cython.ccall
+    def setFlag(self, mask, value):
+        if value:
+            self.r[F] |= mask
+        else:
+            self.r[F] &= ~mask & 0xFF
+
+    @property
+    def AF(self):
+        return self.get16(A, F)
+
+    @AF.setter
+    def AF(self, value):
+        self.set16(A, F, value)
+
+    @property
+    def BC(self):
+        return self.get16(B, C)
+
+    @BC.setter
+    def BC(self, value):
+        self.set16(B, C, value)
+
+    @property
+    def DE(self):
+        return self.get16(D, E)
+
+    @DE.setter
+    def DE(self, value):
+        self.set16(D, E, value)
+
+    @property
+    def HL(self):
+        return self.get16(H, L)
+
+    @HL.setter
+    def HL(self, value):
+        self.set16(H, L, value)
+
     def print(self):
         print(
             f"AF: {hex(self.AF)} BC: {hex(self.BC)} DE: {hex(self.DE)} HL: {hex(self.HL)} PC: {hex(self.PC)} SP: {hex(self.SP)}")
 
+    # String keyed access, slow, kept for debugging tools
     def __setitem__(self, key: str, value: int):
-        if key in REGISTERS_HIGH:
-            register = REGISTERS_HIGH[key]
-            current_value = self[register]
-            setattr(self, register, (current_value & 0x00FF | (value << 8)) & 0xFFFF)
-        elif key in REGISTERS_LOW:
-            register = REGISTERS_LOW[key]
-            current_value = self[register]
-            setattr(self, register, (current_value & 0xFF00 | value & 0x00FF) & 0xFFFF)
+        if key in REGISTERS_8:
+            self.r[REGISTERS_8[key]] = value & 0xFF
+        elif key in REGISTERS_16:
+            hi, lo = REGISTERS_16[key]
+            self.set16(hi, lo, value)
         elif key in FLAGS:
             assert value in (0, 1), f"{value} must be 0 or 1"
-            flag_bit = FLAGS[key]
-            if value == 0:
-                self.AF = self.AF & ~(1 << flag_bit)
-            else:
-                self.AF = self.AF | (1 << flag_bit)
+            self.setFlag(1 << FLAGS[key], value)
+        elif key == "SP":
+            self.SP = value & 0xFFFF
+        elif key == "PC":
+            self.PC = value & 0xFFFF
         else:
-            if key in REGISTERS:
-                setattr(self, key, value & 0xFFFF)
-            else:
-                raise KeyError(f"No such register {key}")
+            raise KeyError(f"No such register {key}")
 
     def __delitem__(self, key: str):
         raise NotImplementedError("Register deletion is not supported")
 
     def __getitem__(self, key: str):
-        # Shift 8 bits to get high bits in register
-        if key in REGISTERS_HIGH:
-            register = REGISTERS_HIGH[key]
-            return getattr(self, register) >> 8
-        # Compare to get lower bits in register
-        elif key in REGISTERS_LOW:
-            register = REGISTERS_LOW[key]
-            return getattr(self, register) & 0xFF
+        if key in REGISTERS_8:
+            return self.r[REGISTERS_8[key]]
+        elif key in REGISTERS_16:
+            hi, lo = REGISTERS_16[key]
+            return self.get16(hi, lo)
         # Shift [Flag] bits to get flag, and check if flag is set
         elif key in FLAGS:
-            flag_bit = FLAGS[key]
-            return self.AF >> flag_bit & 1
-        # Else get whole register
+            return self.r[F] >> FLAGS[key] & 1
+        elif key == "SP":
+            return self.SP
+        elif key == "PC":
+            return self.PC
         else:
-            if key in REGISTERS:
-                return getattr(self, key)
-            else:
-                raise KeyError(f"No such register {key}")
\ No newline at end of file
+            raise KeyError(f"No such register {key}")
@@ -0,0 +1,90 @@
+# Rewind
+# cython: annotation_typing = False
+# Save states taken every interval frames, kept in a ring buffer within a memory budget.
+# The newest state is kept whole, each older one as the zlib compressed xor with the state after it,
+# so dropping the oldest never breaks the chain and going back walks from the newest state.
+import time
+import zlib
+from collections import deque
+
+
+# xor of two states of the same length
+def xorStates(a, b):
+    return (int.from_bytes(a, "little") ^ int.from_bytes(b, "little")).to_bytes(len(a), "little")
+
+
+class Rewind:
+    def __init__(self, cpu, interval=4, budget=4 << 20, level=1):
+        self.cpu = cpu
+        # frames between states
+        self.interval = interval
+        # bytes the history may use
+        self.budget = budget
+        # zlib level of the deltas
+        self.level = level
+        # newest state and its frame
+        self.latest = None
+        self.latest_frame = -1
+        # (frame, compressed xor with the next state), oldest first
+        self.history = deque()
+        self.used = 0
+        # states taken and the host time spent taking them
+        self.captures = 0
+        self.capture_time = 0
+
+    # call after each frame, takes a state every interval frames
+    def record(self):
+        frame = self.cpu.frames
+        if frame % self.interval or frame <= self.latest_frame:
+            return
+        start = time.perf_counter()
+        state = self.cpu.saveState()
+        if self.latest is not None:
+            delta = zlib.compress(xorStates(self.latest, state), self.level)
+            self.history.append((self.latest_frame, delta))
+            self.used += len(delta)
+        self.latest = state
+        self.latest_frame = frame
+        # drop the oldest states over the budget
+        while self.history and self.used + len(state) > self.budget:
+            self.used -= len(self.history.popleft()[1])
+        self.captures += 1
+        self.capture_time += time.perf_counter() - start
+
+    # runs count frames, recording after each
+    def runFrames(self, count):
+        for _ in range(count):
+            self.cpu.runFrames(1)
+            self.record()
+
+    # oldest frame that can be reached
+    def oldestFrame(self):
+        if self.history:
+            return self.history[0][0]
+        return self.latest_frame
+
+    # goes back to frame: restores the newest state at or before it and runs up to it.
+    # The states after it are dropped, recording continues from there
+    def seek(self, frame):
+        if self.latest is None or frame < self.oldestFrame():
+            raise ValueError(f"Frame {frame} is not in the rewind history")
+        state = self.latest
+        while self.latest_frame > frame:
+            self.latest_frame, delta = self.history.pop()
+            self.used -= len(delta)
+            state = xorStates(state, zlib.decompress(delta))
+        self.latest = state
+        self.cpu.loadState(state)
+        self.cpu.runFrames(frame - self.latest_frame)
+
+    # one frame back
+    def stepBack(self):
+        self.seek(self.cpu.frames - 1)
+
+    # frames of history, states kept, bytes used including the newest state, and the mean host time
+    # of taking a state per emulated frame
+    def stats(self):
+        frames = self.latest_frame - self.oldestFrame()
+        used = self.used + (len(self.latest) if self.latest is not None else 0)
+        per_frame = self.capture_time / (self.captures * self.interval) if self.captures else 0
+        return frames, len(self.history) + (self.latest is not None), used, per_frame
@@ -0,0 +1,14 @@
+from libc.stdint cimport int64_t, uint8_t, uint16_t, uint32_t, uint64_t
+
+import cython
+
+cdef class Scheduler:
+    cdef public uint64_t now, deadline
+    cdef uint64_t[3] events
+
+    cpdef void schedule(self, uint8_t, uint64_t)
+    @cython.locals(deadline=uint64_t, n=int)
+    cdef void updateDeadline(self)
+    cpdef bint due(self, uint8_t)
+    cpdef bytes saveState(self)
+    cpdef void loadState(self, bytes)
@@ -0,0 +1,46 @@
+# Event scheduler
+# cython: annotation_typing = False
+# The timer and screen run behind the cpu and only catch up when one of their events is due
+# or the cpu accesses their registers. Each device registers when its next event happens.
+
+import struct
+
+# Event sources
+TIMER, SCREEN, INPUT = range(3)
+SOURCES = 3
+# no event scheduled
+NEVER = 1 << 62
+# Save state part: now and the event of each source
+STATE = struct.Struct("<QQQQ")
+
+
+class Scheduler:
+    def __init__(self):
+        # cycle the devices are synced to
+        self.now = 0
+        # cycle of the next event of each source, and the earliest of them
+        self.events = [NEVER, NEVER, NEVER]
+        self.deadline = NEVER
+
+    # registers the next event of source, cycles from now, NEVER for none
+    def schedule(self, source, cycles):
+        self.events[source] = self.now + cycles if cycles < NEVER else NEVER
+        self.updateDeadline()
+
+    def updateDeadline(self):
+        deadline = NEVER
+        for n in range(SOURCES):
+            if self.events[n] < deadline:
+                deadline = self.events[n]
+        self.deadline = deadline
+
+    # whether the event of source has been reached
+    def due(self, source):
+        return self.events[source] <= self.now
+
+    def saveState(self):
+        return STATE.pack(self.now, self.events[TIMER], self.events[SCREEN], self.events[INPUT])
+
+    def loadState(self, data):
+        self.now, self.events[TIMER], self.events[SCREEN], self.events[INPUT] = STATE.unpack(data)
+        self.updateDeadline()
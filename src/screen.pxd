@@ -1,11 +1,13 @@
 import cython
 
 from cpython.array cimport array
+cimport scheduler
 from libc.stdint cimport int16_t, int64_t, uint8_t, uint16_t, uint32_t, uint64_t
 
 cdef class Screen:
-    cdef uint8_t[8192] VRAM
+    cdef uint8_t[::1] VRAM
     cdef uint8_t[0xA0] OAM
+    cdef uint64_t[144] sprite_lines
     cdef uint8_t SCY
     cdef uint8_t SCX
     cdef uint8_t WY
@@ -19,33 +21,50 @@ cdef class Screen:
     cdef Palette OBP0
     cdef Palette OBP1
     cdef TileCache tile_cache
+    cdef TileLayers layers
     cdef int scan_counter
+    cdef int off_counter
+    cdef int drawn, passed
     cdef uint8_t next_mode
     cdef cpu
-    cdef int[160 * 144 * 3] screenBuffer
-    cdef _screen
-    cdef _last_draw
-    cdef clock
-    cdef font
+    cdef scheduler.Scheduler scheduler
+    cdef bytearray screenBuffer
+    cdef display
 
     cpdef void update(self, uint64_t)
-    cdef void drawScanline(self)
-    @cython.locals(wx=int,x=int,xPos=int,yPos=int,offset=uint16_t,tile_index=int,color=uint32_t,xmask=int,xmaskeq=int)
-    cdef void renderBackground(self)
-    @cython.locals(spriteheight=int,spritecount=int,n=int,x=int,y=int,attr=int,
-    yflip=bint,xflip=bint,line=int,byte1=uint8_t,byte2=uint8_t,i=int,index=int,
+    @cython.locals(cycles=uint64_t, stat=uint8_t, mode=uint8_t, next_mode=uint8_t, LY=int, length=int, lyc=bint)
+    cdef uint64_t cyclesToInterrupt(self)
+    @cython.locals(cycles=uint64_t)
+    cpdef uint64_t cyclesToChange(self, uint16_t)
+    @cython.locals(first=int, LY=int)
+    cdef void renderLines(self, int)
+    cdef void drawScanline(self, int)
+    @cython.locals(wx=int, end=int, row=int, x=int, start=int, layer=bytearray, pixels=bytearray)
+    cdef void renderBackground(self, int)
+    @cython.locals(slots=uint64_t,order=uint16_t[10],count=int,key=uint16_t,k=int,spriteheight=int,n=int,x=int,y=int,
+    tile_index=int,attr=int,yflip=bint,xflip=bint,line=int,byte1=uint8_t,byte2=uint8_t,row=int,colors=uint8_t[::1],i=int,
     color_index=uint8_t,color=uint32_t,xpixel=int)
-    cdef void renderSprites(self)
+    cdef void renderSprites(self, int)
+    @cython.locals(y=int, spriteheight=int, bit=uint64_t, LY=int)
+    cdef void spriteLines(self, int, bint)
+    @cython.locals(n=int, LY=int)
+    cdef void indexSprites(self)
     @cython.locals(x=int,color=uint8_t,color_index=uint8_t)
-    cdef void renderBlank(self)
+    cdef void renderBlank(self, int)
     @cython.locals(offset=int)
     cdef inline void setPixelColor(self,int,int,uint32_t)
-    @cython.locals(tile_addr=uint64_t, tile_index=int)
-    cdef inline int getTile(self,int,int,uint16_t)
+    @cython.locals(moved=list, n=int)
+    cpdef void setOAM(self, bytes)
+    cpdef bytes getFrame(self)
+    @cython.locals(n=int, tile_index=int)
+    cpdef void decodeTiles(self, int)
+    cpdef bytes saveState(self)
+    @cython.locals(window=int, lcdc=uint8_t, bgp=uint8_t, obp0=uint8_t, obp1=uint8_t, offset=int, part=bytes)
+    cpdef void loadState(self, bytes)
     cdef void updatePyGame(self)
-    @cython.locals(prev=bint)
+    @cython.locals(prev=bint, height=bint, old=uint8_t, tile_index=int)
     cpdef void screenSet(self, uint16_t, uint8_t)
-    cpdef uint16_t screenGet(self, uint16_t, uint8_t counter=*)
+    cpdef uint8_t screenGet(self, uint16_t)
     @cython.locals(interrupt=bint)
     cdef inline checkLYC(self)
     @cython.locals(interrupt=bint)
@@ -54,6 +73,7 @@ cdef class Screen:
 
 cdef class LCDCRegister:
     cdef uint8_t value
+    @cython.locals(signed=uint8_t)
     cdef void set(self, uint64_t)
     cdef bint lcd_enable
     cdef bint windowmap_select
@@ -67,6 +87,8 @@ cdef class LCDCRegister:
 
     cdef uint16_t backgroundmap_offset
     cdef uint16_t windowmap_offset
+    cdef uint8_t background_layer
+    cdef uint8_t window_layer
 
 
 cdef class STATRegister:
@@ -80,6 +102,7 @@ cdef class Palette:
     cdef uint8_t value
     cdef uint32_t[4] lookup
     cdef uint32_t[4] palette_mem_rgb
+    cdef bytes table
 
     @cython.locals(x=uint16_t)
     cdef bint set(self, uint64_t)
@@ -90,8 +113,26 @@ cdef class TileCache:
     cdef array tile_state
     cdef array tile_cache_raw
     cdef uint8_t[:,:,:] tile_cache
+    cdef uint8_t[::1] tile_rows
+    cdef uint8_t[::1] row_colors
+    cdef uint8_t[::1] row_colors_flipped
 
-    @cython.locals(y=cython.int,x=cython.int,i=cython.int,byte1=uint8_t,byte2=uint8_t,col_index=uint8_t)
+    @cython.locals(y=cython.int,address=cython.int,offset=cython.int,row=cython.int)
     cdef void updateTile(self, int, Screen)
     cdef void clearCache(self)
-    cdef void clearTile(self, int)
\ No newline at end of file
+    cdef void clearTile(self, int)
+
+cdef class TileLayers:
+    cdef list layers
+    cdef list dirty
+    cdef list users
+    cdef bint cleared
+
+    cdef void clearLayers(self)
+    @cython.locals(tile_map=int, entry=int)
+    cdef void mapChanged(self, int, uint8_t)
+    @cython.locals(tile_map=int, users=set)
+    cdef void tileChanged(self, int)
+    @cython.locals(tile_map=int, users=list, tile=set, entry=int, dirty=set, pixels=bytearray, blocks=uint8_t[::1],
+                   tile_cache=TileCache, tile_number=int, tile_index=int, offset=int, block=int, y=int)
+    cdef bytearray refresh(self, Screen, int)
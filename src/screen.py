@@ -1,10 +1,32 @@
-import pygame
-import sys
+import struct
 from array import array
+from scheduler import SCREEN, NEVER
+
+# Save state part: SCY, SCX, WY, WY_counter + 1 (it is -1 between frames), WX, LY, LYC, LCDC, STAT, STAT mode, BGP, OBP0, OBP1,
+# next mode, scan counter, lcd off counter, then OAM. VRAM is saved by the memory
+STATE = struct.Struct("<14Bii")
+# cycles of a frame, 154 lines
+FRAME_CYCLES = 70224
+# tile states of an empty tile cache
+CLEARED_TILES = array("B", bytes(384))
+# the bits of each byte spread one to a byte, bit 7 in the top byte
+SPREAD = [sum(((value >> bit) & 1) << bit * 8 for bit in range(8)) for value in range(256)]
+# color indices of the 8 pixels of a tile row (low byte, high byte) at (high << 8 | low) * 8, left to right:
+# bit 7 is the leftmost pixel, the high byte gives the high bit of each index
+ROW_COLORS = bytearray(b"".join((SPREAD[low] | SPREAD[high] << 1).to_bytes(8, "big")
+                                for high in range(256) for low in range(256)))
+# the same right to left, for sprites flipped horizontally
+ROW_COLORS_FLIPPED = bytearray(b"".join((SPREAD[low] | SPREAD[high] << 1).to_bytes(8, "little")
+                                        for high in range(256) for low in range(256)))
+
+
 class Screen:
     def __init__(self, cpu):
-        self.VRAM = [0] * 8192
-        self.OAM = [0] * 0xA0
+        # view of the video ram held by the memory, which reads it directly
+        self.VRAM = cpu.decoder.memory.vram
+        self.OAM = bytearray(0xA0)
+        # OAM slots of the sprites on each line, bit n is set for slot n
+        self.sprite_lines = [0] * 144
         self.LCDC = LCDCRegister()  # ($FF40)
         self.STAT = STATRegister()  # ($FF41)
         self.SCY = 0  # BG scroll y
@@ -15,32 +37,34 @@ class Screen:
         self.LY = 0  # LCDC Y-coordinate ($FF44)
         self.LYC = 0  # LY Compare (if equal to LY, it causes STAT to set coincident flag) ($FF45)
         self.scan_counter = 456
+        # cycles left of the frame while the lcd is off, frames keep their length without it
+        self.off_counter = FRAME_CYCLES
+        # lines drawn this frame and lines that reached HBlank, where they are drawn. The lines in between are
+        # drawn together, with the registers as they are, before a write that changes how they look or at VBlank
+        self.drawn = 0
+        self.passed = 0
         self.BGP = Palette(0xFC)
         self.OBP0 = Palette(0xFF)
         self.OBP1 = Palette(0xFF)
 
         # store cpu
         self.cpu = cpu
+        self.scheduler = cpu.scheduler
 
         # tile cache
         self.tile_cache = TileCache()
+        # background and window drawn from the two tile maps
+        self.layers = TileLayers()
 
-        # screen buffer
-        self.screenBuffer = [0] * 160 * 144 * 3
-        self._screen = pygame.display.set_mode((160 * 2, 144 * 2))
-        pygame.display.set_caption("PyGB")
-        self._screen.fill((0, 0, 0))
-
-        # init pygame screen
-        pygame.init()
-        pygame.display.update()
-        self._last_draw = pygame.time.get_ticks()
-        self.clock = pygame.time.Clock()
-        self.font = pygame.font.SysFont("Arial", 18)
+        # RGB screen buffer
+        self.screenBuffer = bytearray(160 * 144 * 3)
+        # window showing the buffer, None when headless
+        self.display = cpu.display
 
         # set up
         self.STAT.set_mode(0)
         self.next_mode = 2
+        self.scheduler.schedule(SCREEN, self.cyclesToInterrupt())
     def update(self, cycles):
         if cycles == 0:
             return
@@ -48,13 +72,22 @@ class Screen:
         if self.LCDC.lcd_enable:
             self.scan_counter -= cycles
         else:
+            self.off_counter -= cycles
+            while self.off_counter <= 0:
+                self.off_counter += FRAME_CYCLES
+                self.cpu.endFrame()
+                if self.display is not None:
+                    self.display.tick()
+            if self.scheduler.due(SCREEN):
+                self.scheduler.schedule(SCREEN, self.cyclesToInterrupt())
             return
 
-        # next scanline
-        if self.scan_counter <= 0:
+        # next mode, blocks can span more than one
+        while self.scan_counter <= 0:
             # If at the end, reset back to OAM scan (MODE 2)
             if self.LY == 153:
                 self.LY = 0
+                self.drawn = self.passed = 0
                 # OAM logic without inc (LY = 0 was our inc)
                 self.setMode(2)
                 self.scan_counter += 80
@@ -77,8 +110,11 @@ class Screen:
                 # H-BLANK (MODE 0)
                 elif self.STAT._mode == 0:
                     self.scan_counter += 204
-                    self.drawScanline()
-                    self.updatePyGame()
+                    # lines that never reached HBlank, the first one after the lcd is turned on, are not drawn
+                    if self.passed < self.LY:
+                        self.renderLines(self.passed)
+                        self.drawn = self.LY
+                    self.passed = self.LY + 1
                     if self.LY < 143:
                         self.next_mode = 2
                     else:
@@ -92,8 +128,76 @@ class Screen:
                     self.checkLYC()
                     # V-BLANK INTERRUPT
                     if self.LY == 144:
+                        self.renderLines(self.passed)
+                        self.updatePyGame()
                         self.cpu.setInterrupt(0)
-                        self.clock.tick()
+                        self.cpu.endFrame()
+                        if self.display is not None:
+                            self.display.tick()
+        # the next interrupt only moves when it happens or a register is written
+        if self.scheduler.due(SCREEN):
+            self.scheduler.schedule(SCREEN, self.cyclesToInterrupt())
+    # Cycles until the screen requests an interrupt: VBlank, a STAT mode with its interrupt enabled
+    # or LY matching LYC. Steps through the mode changes like update without applying them,
+    # the rest of the screen only needs to catch up when the cpu accesses it.
+    # With the lcd off, cycles until the end of the frame, which is still counted
+    def cyclesToInterrupt(self):
+        if not self.LCDC.lcd_enable:
+            return max(self.off_counter, 1)
+        # 0 right after the lcd is turned on, the mode changes on the next tick
+        cycles = max(self.scan_counter, 1)
+        stat = self.STAT.value
+        mode = self.STAT._mode
+        next_mode = self.next_mode
+        LY = self.LY
+        # VBlank comes at least once a frame
+        while True:
+            lyc = False
+            if LY == 153:
+                LY = 0
+                next_mode = 2
+                length = 80
+                lyc = True
+            elif next_mode == 2:
+                LY += 1
+                length = 80
+                lyc = True
+            elif next_mode == 3:
+                length = 172
+            elif next_mode == 0:
+                length = 204
+            else:
+                LY += 1
+                length = 456
+                lyc = True
+                if LY == 144:
+                    return cycles
+            if next_mode != mode and next_mode != 3 and stat & (1 << (next_mode + 3)):
+                return cycles
+            if lyc and LY == self.LYC and stat & 0b0100_0000:
+                return cycles
+            mode = next_mode
+            if mode == 2:
+                next_mode = 3
+            elif mode == 3:
+                next_mode = 0
+            elif mode == 0:
+                next_mode = 2 if LY < 143 else 1
+            cycles += length
+
+    # cycles until the register at address changes by itself, STAT with every mode and LY with every line
+    def cyclesToChange(self, address):
+        if not self.LCDC.lcd_enable or (address != 0xFF41 and address != 0xFF44):
+            return NEVER
+        cycles = max(self.scan_counter, 1)
+        if address == 0xFF44 and self.LY != 153:
+            # LY is incremented entering OAM scan or on a VBlank line
+            if self.next_mode == 3:
+                cycles += 172 + 204
+            elif self.next_mode == 0:
+                cycles += 204
+        return cycles
+
     def checkLYC(self):
         interrupt = self.STAT.update_LYC(self.LYC, self.LY)
         if interrupt:
@@ -102,145 +206,207 @@ class Screen:
         interrupt = self.STAT.set_mode(newmode)
         if interrupt:
             self.cpu.setInterrupt(1)
-    def drawScanline(self):
+    # draws the lines from drawn up to last, all with the registers as they are now
+    def renderLines(self, last):
+        first = self.drawn
+        if first >= last:
+            return
+        self.drawn = last
+        for LY in range(first, last):
+            self.drawScanline(LY)
+    def drawScanline(self, LY):
         # Tick window if we are within
-        if self.LCDC.window_enable and self.WY <= self.LY and self.WX - 7 < 160:
+        if self.LCDC.window_enable and self.WY <= LY and self.WX - 7 < 160:
             self.WY_counter += 1
         if self.LCDC.background_enable:
-            self.renderBackground()
+            self.renderBackground(LY)
         else:
-            self.renderBlank()
+            self.renderBlank(LY)
         if self.LCDC.sprite_enable:
-            self.renderSprites()
+            self.renderSprites(LY)
         # reset window counter
-        if self.LY == 143:
+        if LY == 143:
             self.WY_counter = -1
-    def renderBlank(self):
+    def renderBlank(self, LY):
         for x in range(0, 160):
             color = self.BGP.getcolor(0)
-            self.setPixelColor(x, self.LY, color)
-    def renderBackground(self):
+            self.setPixelColor(x, LY, color)
+    def renderBackground(self, LY):
         wx = self.WX - 7
-        for x in range(0, 160):
-            # If we are in range of the window
-            if self.LCDC.window_enable and self.WY <= self.LY and x >= wx:
-                xPos = x - wx
-                yPos = self.WY_counter
-                offset = self.LCDC.windowmap_offset
-                xmask = xPos % 8
-                xmaskeq = wx
-
-            # Otherwise, default to background
+        # the background is left of the window
+        end = 160
+        if self.LCDC.window_enable and self.WY <= LY and wx < 160:
+            end = max(wx, 0)
+        pixels = bytearray()
+        if end:
+            layer = self.layers.refresh(self, self.LCDC.background_layer)
+            # the line of the layer, wrapping around at its right edge
+            row = ((self.SCY + LY) & 0xFF) << 8
+            x = self.SCX
+            if x + end > 0x100:
+                pixels = layer[row + x:row + 0x100] + layer[row:row + x + end - 0x100]
             else:
-                xPos = x + self.SCX
-                yPos = self.SCY + self.LY
-                offset = self.LCDC.backgroundmap_offset
-                xmask = (x + (self.SCX & 0b111)) % 8
-                xmaskeq = 0
-
-            if xmask == 0 or x == xmaskeq:
-                tile_index = self.getTile(xPos, yPos, offset)
-                self.tile_cache.updateTile(tile_index, self)
-
-            color_index = self.tile_cache.tile_cache[tile_index, xPos % 8, yPos % 8]
-            color = self.BGP.getcolor(color_index)
-            self.setPixelColor(x, self.LY, color)
-    def renderSprites(self):
+                pixels = layer[row + x:row + x + end]
+        if end < 160:
+            layer = self.layers.refresh(self, self.LCDC.window_layer)
+            row = (self.WY_counter & 0xFF) << 8
+            pixels += layer[row + end - wx:row + 160 - wx]
+        # colors of the color indices, each for the 3 bytes of a pixel
+        pixels = pixels.translate(self.BGP.table)
+        start = LY * 160 * 3
+        self.screenBuffer[start:start + 160 * 3:3] = pixels
+        self.screenBuffer[start + 1:start + 160 * 3:3] = pixels
+        self.screenBuffer[start + 2:start + 160 * 3:3] = pixels
+    def renderSprites(self, LY):
+        slots = self.sprite_lines[LY]
+        if not slots:
+            return
         spriteheight = 16 if self.LCDC.sprite_height else 8
-        spritecount = 0
-        # count which sprites to render
-        for n in range(0x00, 0xA0, 4):
+        # The first 10 sprites of the line in slot order are shown. The one with the smaller x, then the lower slot,
+        # is in front, so they are sorted by x and slot to be drawn from the back
+        order = [0] * 10
+        count = 0
+        n = 0
+        while count < 10 and slots >> n:
+            if slots >> n & 1:
+                key = self.OAM[n * 4 + 1] << 6 | n
+                i = count
+                while i and order[i - 1] < key:
+                    order[i] = order[i - 1]
+                    i -= 1
+                order[i] = key
+                count += 1
+            n += 1
+        for k in range(count):
+            n = (order[k] & 63) * 4
             y = self.OAM[n] - 16
             x = self.OAM[n + 1] - 8
-            if y <= self.LY < y + spriteheight:
-                # attributes
-                tile_index = self.OAM[n + 2]
-                # If spriteheight is 16, ignore bit 0
-                if spriteheight == 16:
-                    tile_index &= 0b11111110
-                attr = self.OAM[n + 3]
-                yflip = (attr >> 6) & 1
-                xflip = (attr >> 5) & 1
-
-                line = self.LY - y
-                if yflip:
-                    line -= spriteheight
-                    line *= -1
-                    # no idea why this fixes yflip
-                    line -= 1
-                line *= 2
-
-                byte1 = self.VRAM[tile_index * 16 + line]
-                byte2 = self.VRAM[tile_index * 16 + line + 1]
-
-                for i in range(7, -1, -1):
-                    index = i
-                    if xflip:
-                        index -= 7
-                        index *= -1
-
-                    color_index = ((byte2 >> index) & 1) << 1
-                    color_index |= (byte1 >> index) & 1
-
-                    if attr & 0b10000:
-                        color = self.OBP1.getcolor(color_index)
-                    else:
-                        color = self.OBP0.getcolor(color_index)
-
-                    # if sprite is transparent
-                    if color == 0xFF:
-                        continue
-
-                    # TODO: implement sprite priority
-                    # Set color
-                    xpixel = 7 - i + x
-                    self.setPixelColor(xpixel, self.LY, color)
-                spritecount += 1
-
-            if spritecount == 10:
-                break
+            # attributes
+            tile_index = self.OAM[n + 2]
+            # If spriteheight is 16, ignore bit 0
+            if spriteheight == 16:
+                tile_index &= 0b11111110
+            attr = self.OAM[n + 3]
+            yflip = (attr >> 6) & 1
+            xflip = (attr >> 5) & 1
+
+            line = LY - y
+            if yflip:
+                line = spriteheight - 1 - line
+            line *= 2
+
+            byte1 = self.VRAM[tile_index * 16 + line]
+            byte2 = self.VRAM[tile_index * 16 + line + 1]
+            # color indices of the row, left to right
+            row = (byte2 << 8 | byte1) * 8
+            colors = self.tile_cache.row_colors_flipped if xflip else self.tile_cache.row_colors
+
+            for i in range(8):
+                color_index = colors[row + i]
+
+                # color 0 is transparent
+                if color_index == 0:
+                    continue
+
+                if attr & 0b10000:
+                    color = self.OBP1.getcolor(color_index)
+                else:
+                    color = self.OBP0.getcolor(color_index)
+
+                # TODO: implement background priority (attribute bit 7)
+                # Set color, off screen pixels are left out
+                xpixel = x + i
+                if 0 <= xpixel < 160:
+                    self.setPixelColor(xpixel, LY, color)
+    # adds the sprite in OAM slot n to the sprite lines it is on, or removes it
+    def spriteLines(self, n, add):
+        y = self.OAM[n * 4] - 16
+        spriteheight = 16 if self.LCDC.sprite_height else 8
+        # shifted as a 64 bit value, slots go up to 39
+        bit = 1
+        bit <<= n
+        for LY in range(max(y, 0), min(y + spriteheight, 144)):
+            if add:
+                self.sprite_lines[LY] |= bit
+            else:
+                self.sprite_lines[LY] &= ~bit
+    # rebuilds the sprite lines from OAM
+    def indexSprites(self):
+        for LY in range(144):
+            self.sprite_lines[LY] = 0
+        for n in range(40):
+            self.spriteLines(n, True)
     def setPixelColor(self, x, y, color):
         offset = (y * 160 + x) * 3
         self.screenBuffer[offset] = color
         self.screenBuffer[offset + 1] = color
         self.screenBuffer[offset + 2] = color
-    def getTile(self, x, y, offset):
-        tile_addr = offset + y // 8 * 32 % 0x400 + x // 8 % 32 # tilemap offset + tileRow + tileCol
-        tile_index = self.VRAM[tile_addr]
-        # signed
-        if not self.LCDC.tiledata_select:
-            tile_index = (tile_index ^ 0x80) + 128
-        return tile_index
+    # the screen buffer is output and is left out, it is redrawn line by line
+    def saveState(self):
+        # the window counter is up to date once the passed lines are drawn
+        self.renderLines(self.passed)
+        return (STATE.pack(self.SCY, self.SCX, self.WY, (self.WY_counter + 1) & 0xFF, self.WX, self.LY, self.LYC, self.LCDC.value,
+                           self.STAT.value, self.STAT._mode, self.BGP.value, self.OBP0.value, self.OBP1.value,
+                           self.next_mode, self.scan_counter, self.off_counter)
+                + bytes(self.OAM[0:0xA0]))
+
+    # data is bytes, the part written by saveState
+    def loadState(self, data):
+        (self.SCY, self.SCX, self.WY, window, self.WX, self.LY, self.LYC, lcdc, self.STAT.value, self.STAT._mode,
+         bgp, obp0, obp1, self.next_mode, self.scan_counter, self.off_counter) = STATE.unpack_from(data)
+        self.WY_counter = window - 1
+        self.LCDC.set(lcdc)
+        self.BGP.set(bgp)
+        self.OBP0.set(obp0)
+        self.OBP1.set(obp1)
+        offset = STATE.size
+        # the slice is held in part, the array is copied from it
+        part = data[offset : offset + 0xA0]
+        self.OAM[0:0xA0] = part
+        self.indexSprites()
+        self.tile_cache.clearCache()
+        # the video ram is loaded by the memory after this
+        self.layers.clearLayers()
+        # the lines already passed stay as they are
+        if not self.LCDC.lcd_enable:
+            self.drawn = self.passed = 0
+        elif self.STAT._mode == 1:
+            self.drawn = self.passed = 144
+        elif self.STAT._mode == 0:
+            self.drawn = self.passed = self.LY + 1
+        else:
+            self.drawn = self.passed = self.LY
+
+    # data is the 160 bytes of an oam dma
+    def setOAM(self, data):
+        self.renderLines(self.passed)
+        # the sprites that move to other lines
+        moved = [n for n in range(40) if self.OAM[n * 4] != data[n * 4]]
+        for n in moved:
+            self.spriteLines(n, False)
+        self.OAM[0:0xA0] = data
+        for n in moved:
+            self.spriteLines(n, True)
+
+    # copy of the RGB screen buffer, with the lines passed so far
+    def getFrame(self):
+        self.renderLines(self.passed)
+        return bytes(self.screenBuffer)
+
+    # drops and decodes count tiles of the tile cache again from the video ram, to time tile decoding
+    def decodeTiles(self, count):
+        for n in range(count):
+            tile_index = n % 384
+            self.tile_cache.clearTile(tile_index)
+            self.tile_cache.updateTile(tile_index, self)
     def updatePyGame(self):
-        try:
-            current_time = pygame.time.get_ticks()
-            # Here we limit FPS to get better performance
-            if current_time > self._last_draw + 40:
-                self._last_draw = current_time
-                main_surface = pygame.image.frombuffer(bytearray(self.screenBuffer), (160, 144), "RGB")
-                main_surface = pygame.transform.scale_by(main_surface, 2)
-                self._screen.blit(main_surface, (0, 0))
-
-                # Show fps
-                fps = str(int(self.clock.get_fps()))
-                fps_text = self.font.render(fps, False, pygame.Color("coral"))
-                self._screen.blit(fps_text, (10, 10))
-
-                # update
-                pygame.display.update()
-
-
-        except BaseException as e:
-            raise Exception(f"Pygame frame error: {repr(e)}")
-    def screenGet(self, address, counter = 1):
+        if self.display is not None and self.display.ready():
+            self.display.present(bytearray(self.screenBuffer))
+    def screenGet(self, address):
         if 0x8000 <= address < 0xA000:
-            temp = address - 0x8000
-            data = self.VRAM[temp: temp + counter]
-            return int.from_bytes(data, sys.byteorder)
+            return self.VRAM[address - 0x8000]
         elif 0xFE00 <= address < 0xFEA0:
-            temp = address - 0xFE00
-            data = self.OAM[temp : temp + counter]
-            return int.from_bytes(data, sys.byteorder)
+            return self.OAM[address - 0xFE00]
         elif address == 0xFF40:
             return self.LCDC.value
         elif address == 0xFF41:
@@ -267,20 +433,42 @@ class Screen:
         else:
             return self.WX
     def screenSet(self, address, value):
+        # the lines passed so far are drawn as they were before the write, STAT and LYC don't change them
+        if self.drawn < self.passed and address != 0xFF41 and address != 0xFF45:
+            self.renderLines(self.passed)
         if 0x8000 <= address < 0xA000:
+            old = self.VRAM[address - 0x8000]
+            if old == value:
+                return
             self.VRAM[address - 0x8000] = value
             if address < 0x9800:  # Is within tile data -- not tile maps
-            # Mask out the byte of the tile
-                self.tile_cache.clearTile(((address & 0xFFF0) - 0x8000) // 16)
+                # Mask out the byte of the tile, and the blocks showing it unless they are already
+                tile_index = (address - 0x8000) >> 4
+                if self.tile_cache.tile_state[tile_index]:
+                    self.tile_cache.clearTile(tile_index)
+                    self.layers.tileChanged(tile_index)
+            else:
+                self.layers.mapChanged(address - 0x9800, old)
         elif 0xFE00 <= address < 0xFEA0:
-            self.OAM[address - 0xFE00] = value
+            # a new y moves the sprite to other lines
+            if address & 3 == 0 and self.OAM[address - 0xFE00] != value:
+                self.spriteLines((address - 0xFE00) >> 2, False)
+                self.OAM[address - 0xFE00] = value
+                self.spriteLines((address - 0xFE00) >> 2, True)
+            else:
+                self.OAM[address - 0xFE00] = value
         elif address == 0xFF40:
             prev = self.LCDC.lcd_enable
+            height = self.LCDC.sprite_height
             self.LCDC.set(value)
+            if self.LCDC.sprite_height != height:
+                self.indexSprites()
             if prev and not self.LCDC.lcd_enable:
                 self.scan_counter = 0
+                self.off_counter = FRAME_CYCLES
                 self.setMode(0)
                 self.LY = 0
+                self.drawn = self.passed = 0
             elif not prev and self.LCDC.lcd_enable:
                 pass
         elif address == 0xFF41:
@@ -295,8 +483,8 @@ class Screen:
         elif address == 0xFF45:
             self.LYC = value
         elif address == 0xFF47:
-            if self.BGP.set(value):
-                self.tile_cache.clearCache()
+            # the tile cache and layers hold color indices, the palette is applied after
+            self.BGP.set(value)
         elif address == 0xFF48:
             self.OBP0.set(value)
         elif address == 0xFF49:
@@ -305,6 +493,9 @@ class Screen:
             self.WY = value
         elif address == 0xFF4B:
             self.WX = value
+        # the lcd switch, STAT interrupt enables and LYC move the next interrupt
+        if address == 0xFF40 or address == 0xFF41 or address == 0xFF45:
+            self.scheduler.schedule(SCREEN, self.cyclesToInterrupt())
 
 class STATRegister:
     def __init__(self):
@@ -355,6 +546,8 @@ class LCDCRegister:
         self.background_enable = 0
         self.backgroundmap_offset = 0x1800
         self.windowmap_offset = 0x1800
+        self.background_layer = 2
+        self.window_layer = 2
 
     def set(self, value):
         self.value = value
@@ -372,12 +565,18 @@ class LCDCRegister:
         # Following addresses are 0x9800 and 0x9C00
         self.backgroundmap_offset = 0x1800 if self.backgroundmap_select == 0 else 0x1C00
         self.windowmap_offset = 0x1800 if self.windowmap_select == 0 else 0x1C00
+        # their layers, with the tile numbers signed when tiledata_select is clear (see TileLayers)
+        signed = 2 if self.tiledata_select == 0 else 0
+        self.background_layer = (0 if self.backgroundmap_select == 0 else 1) + signed
+        self.window_layer = (0 if self.windowmap_select == 0 else 1) + signed
 
 class Palette:
     def __init__(self, value):
         self.value = 0
         self.lookup = [0] * 4
         self.palette_mem_rgb = [0xFF, 0x99, 0x55, 0x00]
+        # lookup as a translate table of color indices
+        self.table = bytes(256)
         self.set(value)
 
     def set(self, value):
@@ -387,6 +586,7 @@ class Palette:
         self.value = value
         for x in range(4):
             self.lookup[x] = self.palette_mem_rgb[(value >> x * 2) & 0b11]
+        self.table = bytes(self.lookup) + bytes(252)
         return True
 
     def get(self):
@@ -403,30 +603,105 @@ class TileCache:
         # Tile cache (384 tiles which are 8x8 each)
         self.tile_cache_raw = array("B", [0] * 384 * 8 * 8)
 
-        # Tile cache memory view (In 3D form [Tile_index, x, y])
+        # Tile cache memory view (In 3D form [Tile_index, y, x])
         self.tile_cache = memoryview(self.tile_cache_raw).cast("B", shape=(384, 8, 8))
+        # flat view, 8 bytes to a tile row
+        self.tile_rows = memoryview(self.tile_cache_raw)
+
+        # row decode tables
+        self.row_colors = ROW_COLORS
+        self.row_colors_flipped = ROW_COLORS_FLIPPED
 
     def updateTile(self, tile_index, screen: Screen):
         if self.tile_state[tile_index]:
             return
-        # Cache entire tile
-        for k in range(0, 16, 2):  # 2 bytes for each line
-            byte1 = screen.VRAM[tile_index * 16 + k]
-            byte2 = screen.VRAM[tile_index * 16 + k + 1]
-
-            y = k // 2
-
-            for i in range(0, 8):
-                # byte 2 pixel is most significant, byte 1 is least
-                col_index = ((byte2 >> i) & 1) << 1
-                col_index |= (byte1 >> i) & 1
-                x = 7 - i
-                # Rightmost bit is the leftmost pixel (bit 7 = pixel 0, bit 6 = pixel 1, etc.)
-                self.tile_cache[tile_index, x, y] = col_index
+        # Cache entire tile, a row from each 2 bytes
+        address = tile_index * 16
+        offset = tile_index * 64
+        for y in range(8):
+            # byte 2 pixel is most significant, byte 1 is least
+            row = (screen.VRAM[address + 1] << 8 | screen.VRAM[address]) * 8
+            self.tile_rows[offset:offset + 8] = self.row_colors[row:row + 8]
+            address += 2
+            offset += 8
 
         self.tile_state[tile_index] = 1
     def clearCache(self):
-        for i in range(384):
-            self.tile_state[i] = 0
+        self.tile_state[0:384] = CLEARED_TILES
     def clearTile(self, tile_index):
-        self.tile_state[tile_index] = 0
\ No newline at end of file
+        self.tile_state[tile_index] = 0
+# 256x256 color indices of the background of each tile map (0 at 0x9800, 1 at 0x9C00) with the tile numbers
+# unsigned (LCDC bit 4 set) and signed, kept up to date block by block: layer tile_map + 2 * signed.
+# A block is redrawn when its map entry changes or its tile is written, before a line shows the layer.
+class TileLayers:
+    def __init__(self):
+        self.layers = [bytearray(0x10000) for _ in range(4)]
+        # map entries of each layer to redraw
+        self.dirty = [set() for _ in range(4)]
+        # map entries of each tile map holding each tile number
+        self.users = [[set() for _ in range(256)], [set() for _ in range(256)]]
+        # the users are rebuilt from the video ram before the layers are shown
+        self.cleared = True
+
+    def clearLayers(self):
+        self.cleared = True
+
+    # address is the map entry from 0x9800, old the tile number it held
+    def mapChanged(self, address, old):
+        if self.cleared:
+            return
+        tile_map = address >> 10
+        entry = address & 0x3FF
+        self.users[tile_map][old].discard(entry)
+        self.dirty[tile_map].add(entry)
+        self.dirty[tile_map + 2].add(entry)
+
+    def tileChanged(self, tile_index):
+        if self.cleared:
+            return
+        # tiles 0-127 are only shown unsigned, 256-383 only signed
+        for tile_map in range(2):
+            users = self.users[tile_map][tile_index & 0xFF]
+            if tile_index < 256:
+                self.dirty[tile_map].update(users)
+            if tile_index >= 128:
+                self.dirty[tile_map + 2].update(users)
+
+    # redraws the changed blocks of the layer, and returns it
+    def refresh(self, screen: Screen, layer):
+        if self.cleared:
+            self.cleared = False
+            for tile_map in range(2):
+                users = self.users[tile_map]
+                for tile in users:
+                    tile.clear()
+                for entry in range(0x400):
+                    users[screen.VRAM[0x1800 + tile_map * 0x400 + entry]].add(entry)
+            for dirty in self.dirty:
+                dirty.update(range(0x400))
+        dirty = self.dirty[layer]
+        pixels = self.layers[layer]
+        if not dirty:
+            return pixels
+        # the layer as a typed view when compiled, the rows are copied without objects
+        blocks = pixels
+        tile_cache = screen.tile_cache
+        tile_map = layer & 1
+        users = self.users[tile_map]
+        for entry in dirty:
+            tile_number = screen.VRAM[0x1800 + tile_map * 0x400 + entry]
+            users[tile_number].add(entry)
+            tile_index = tile_number
+            # signed
+            if layer >= 2:
+                tile_index = (tile_index ^ 0x80) + 128
+            tile_cache.updateTile(tile_index, screen)
+            # the 8 rows of the tile into the block, 256 bytes apart
+            offset = tile_index * 64
+            block = (entry >> 5) << 11 | (entry & 31) << 3
+            for y in range(8):
+                blocks[block:block + 8] = tile_cache.tile_rows[offset:offset + 8]
+                offset += 8
+                block += 256
+        dirty.clear()
+        return pixels
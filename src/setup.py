@@ -1,7 +1,12 @@
 from setuptools import setup
 from Cython.Build import cythonize
+from opcodes import getOpcodes
 list = ["cartridge.py", "memory.py", "disassemble.py", "opcodes.py", "timer.py", "screen.py",
-        "cpu.py", "registers.py", "joypad.py"]
+        "cpu.py", "registers.py", "joypad.py", "dispatch.py", "translator.py", "scheduler.py", "display.py", "rewind.py",
+        "battery.py"]
+
+# write the opcode table cache
+getOpcodes("Opcodes.json")
 
 setup(
     ext_modules=cythonize(list, language_level=3)
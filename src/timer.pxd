@@ -1,9 +1,11 @@
 from libc.stdint cimport int64_t, uint8_t, uint16_t, uint32_t, uint64_t
 
 import cython
+cimport scheduler
 
 cdef class Timer:
     cdef int DIV, DIV_counter, TIMA, TMA, TAC, counter
+    cdef scheduler.Scheduler scheduler
 
     cdef void resetCounter(self)
 
@@ -12,8 +14,17 @@ cdef class Timer:
     @cython.locals(c_select=uint8_t)
     cdef uint64_t getFreq(self)
 
+    @cython.locals(interrupt=bint)
     cpdef bint tick(self, uint64_t)
 
+    cdef uint64_t cyclesToOverflow(self)
+
+    cpdef uint64_t cyclesToChange(self, uint16_t)
+
     cpdef void timerSet(self, uint16_t, uint8_t)
 
-    cpdef int timerGet(self, uint16_t)
\ No newline at end of file
+    cpdef int timerGet(self, uint16_t)
+
+    cpdef bytes saveState(self)
+
+    cpdef void loadState(self, bytes)
\ No newline at end of file
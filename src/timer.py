@@ -1,6 +1,13 @@
+import struct
+from scheduler import TIMER, NEVER
+
+# Save state part: DIV, DIV_counter, TIMA, TMA, TAC, counter
+STATE = struct.Struct("<6i")
+
 
 class Timer:
-    def __init__(self):
+    def __init__(self, scheduler):
+        self.scheduler = scheduler
         self.DIV = 0xAD
         self.DIV_counter = 0
         self.TAC = 0
@@ -29,6 +36,7 @@ class Timer:
             self.TAC = value & 0b111
             if temp != self.TAC:
                 self.resetCounter()
+        self.scheduler.schedule(TIMER, self.cyclesToOverflow())
     def resetCounter(self):
         self.counter = self.getFreq()
     def getFreq(self):
@@ -59,7 +67,9 @@ class Timer:
             return False
 
         self.counter -= cycles
-        if self.counter <= 0:
+        interrupt = False
+        # blocks can tick more than one period at once
+        while self.counter <= 0:
             # reset timer counter while keeping overflow
             self.counter += self.getFreq()
             self.TIMA += 1
@@ -68,9 +78,32 @@ class Timer:
                 self.TIMA = self.TMA
                 self.TIMA &= 0xFF
                 # Return interrupt
-                return True
+                interrupt = True
+
+        # the overflow only moves when it happens or a register is written
+        if self.scheduler.due(TIMER):
+            self.scheduler.schedule(TIMER, self.cyclesToOverflow())
+        return interrupt
+
+    # cycles until TIMA overflows
+    def cyclesToOverflow(self):
+        if self.TAC & 0b100 == 0:
+            return NEVER
+        return self.counter + (255 - self.TIMA) * self.getFreq()
+
+    # cycles until the register at address changes by itself
+    def cyclesToChange(self, address):
+        if address == 0xFF04:
+            return 256 - self.DIV_counter
+        elif address == 0xFF05 and self.TAC & 0b100:
+            return self.counter
+        return NEVER
+
+    def saveState(self):
+        return STATE.pack(self.DIV, self.DIV_counter, self.TIMA, self.TMA, self.TAC, self.counter)
 
-        return False
+    def loadState(self, data):
+        self.DIV, self.DIV_counter, self.TIMA, self.TMA, self.TAC, self.counter = STATE.unpack(data)
 
     def reset(self):
         self.DIV_counter = 0
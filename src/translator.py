@@ -0,0 +1,580 @@
+# Block translator
+# cython: annotation_typing = False
+# Straight-line runs of guest code (basic blocks) are translated once into a Python function.
+# A block keeps the registers in locals, skips flag updates that are overwritten before being read
+# and returns the cycles it took and the next pc. The cpu checks interrupts between blocks.
+import re
+from registers import REGISTERS_8 as SLOT_NUMBERS
+
+# longest block in instructions, bounds the interrupt latency
+MAX_BLOCK = 24
+
+# Constants
+REGISTERS_8 = {"A": "a", "B": "b", "C": "c", "D": "d", "E": "e", "H": "h", "L": "l"}
+PAIRS = {"AF": ("a", "f"), "BC": ("b", "c"), "DE": ("d", "e"), "HL": ("h", "l")}
+# condition -> (expression, flags read)
+CONDITIONS = {"NZ": ("not f & 0x80", 0x80), "Z": ("f & 0x80", 0x80),
+              "NC": ("not f & 0x10", 0x10), "C": ("f & 0x10", 0x10)}
+ALU = {"ADD", "ADC", "SUB", "SBC", "AND", "XOR", "OR", "CP"}
+# rotate/shift results with the carry in bit 8, same as dispatch
+SHIFTS = {
+    "RLC": "r = ({x} << 1) + ({x} >> 7)",
+    "RRC": "r = ({x} >> 1) + (({x} & 1) << 7) + (({x} & 1) << 8)",
+    "RL": "r = ({x} << 1) + (f >> 4 & 1)",
+    "RR": "r = ({x} >> 1) + ((f >> 4 & 1) << 7) + (({x} & 1) << 8)",
+    "SLA": "r = {x} << 1",
+    "SRA": "r = (({x} >> 1) | ({x} & 0x80)) + (({x} & 1) << 8)",
+    "SRL": "r = ({x} >> 1) + (({x} & 1) << 8)",
+    "SWAP": "r = (({x} & 0xF0) >> 4) | (({x} & 0x0F) << 4)",
+}
+ROTATES_A = {"RLCA": "RLC", "RRCA": "RRC", "RLA": "RL", "RRA": "RR"}
+# instructions that end a block
+BRANCHES = {"JP", "JR", "CALL", "RET", "RETI", "RST"}
+TERMINALS = BRANCHES | {"HALT", "DI", "EI"}
+LOCALS = ("a", "f", "b", "c", "d", "e", "h", "l", "sp")
+# register slot of each local
+SLOTS = {name.lower(): slot for name, slot in SLOT_NUMBERS.items()}
+
+
+# Code for one instruction
+class Op:
+    def __init__(self):
+        # code lines, ("sync", offset) before a bus access offset cycles into the instruction
+        # and ("flags", line) for the flag update
+        self.items = []
+        # flags set by the flag update and flags it reads
+        self.flag_writes = 0
+        self.flag_reads = 0
+        # flags read by the rest of the instruction
+        self.value_reads = 0
+        # writes to memory
+        self.writes = False
+        # branches: condition, target pc and the code only run when taken
+        self.condition = None
+        self.target = None
+        self.taken = []
+
+    def line(self, *lines):
+        self.items.extend(lines)
+
+    def flags(self, line, writes, reads=0):
+        self.items.append(("flags", line))
+        self.flag_writes = writes
+        self.flag_reads = reads
+
+    def read(self, target, address, offset=0):
+        self.items.append(("sync", offset))
+        self.items.append(f"{target} = read({address})")
+
+    def write(self, address, value, offset=0):
+        self.items.append(("sync", offset))
+        self.items.append(f"write({address}, {value})")
+        self.writes = True
+
+    # little endian word at address
+    def read16(self, target, address, offset=0):
+        self.items.append(("sync", offset))
+        self.items.append(f"{target} = read16({address})")
+
+    def write16(self, address, value, offset=0):
+        self.items.append(("sync", offset))
+        self.items.append(f"write16({address}, {value})")
+        self.writes = True
+
+
+def pair(name):
+    if name == "SP":
+        return "sp"
+    hi, lo = PAIRS[name]
+    return f"({hi} << 8 | {lo})"
+
+
+def setPair(op, name, value):
+    if name == "SP":
+        op.line(f"sp = ({value}) & 0xFFFF")
+    else:
+        hi, lo = PAIRS[name]
+        op.line(f"t = ({value}) & 0xFFFF", f"{hi} = t >> 8", f"{lo} = t & 0xFF")
+
+
+def signed(value):
+    return (value ^ 0x80) - 0x80
+
+
+class Translator:
+    def __init__(self, cpu):
+        self.cpu = cpu
+        self.decoder = cpu.decoder
+
+        # Blocks running from rom, one list of 0x4000 entries per rom bank (like the decode cache)
+        self.bank_caches = {}
+        # one flag per bank, cleared while the bank is switched out
+        self.bank_alive = {}
+        self.rom_cache_low = self.getBankCache(0)
+        self.rom_cache_high = self.getBankCache(1)
+        self.bank = 1
+
+        # Blocks running from internal ram and hram, indexed by address
+        self.ram_cache = [None] * 0x10000
+        # start -> (end, alive flag) of the ram blocks
+        self.ram_blocks = {}
+        # starts of the ram blocks covering each 256 byte page
+        self.page_blocks = [set() for _ in range(0x100)]
+        # marks the ram bytes translated into a block, memory calls invalidate on writes to them
+        self.block_map = bytearray(0x10000)
+        self.decoder.memory.block_map = self.block_map
+
+        # number of translated blocks
+        self.translated = 0
+
+    # get (or create) the block cache of a rom bank
+    def getBankCache(self, bank):
+        cache = self.bank_caches.get(bank)
+        if cache is None:
+            cache = [None] * 0x4000
+            self.bank_caches[bank] = cache
+            self.bank_alive[bank] = [True]
+        return cache
+
+    # called by memory on mbc bank switches, stops the running block if it is in the old bank
+    def selectBank(self, bank):
+        self.bank_alive[self.bank][0] = False
+        self.rom_cache_high = self.getBankCache(bank)
+        self.bank_alive[bank][0] = True
+        self.bank = bank
+
+    # called by memory on writes to translated ram, drops the blocks containing address
+    def invalidate(self, address):
+        dropped = []
+        for start in [start for start in self.page_blocks[address >> 8] if start <= address < self.ram_blocks[start][0]]:
+            end, alive = self.ram_blocks.pop(start)
+            alive[0] = False
+            self.ram_cache[start] = None
+            self.block_map[start:end] = bytes(end - start)
+            for page in range(start >> 8, ((end - 1) >> 8) + 1):
+                self.page_blocks[page].discard(start)
+            dropped.append((start, end))
+        # blocks can overlap, mark the remaining ones again where they overlap a dropped range
+        for start, end in dropped:
+            for page in range(start >> 8, ((end - 1) >> 8) + 1):
+                for other in self.page_blocks[page]:
+                    first = max(other, start)
+                    last = min(self.ram_blocks[other][0], end)
+                    if first < last:
+                        self.block_map[first:last] = b"\x01" * (last - first)
+
+    # drops every ram block, after the ram contents were replaced
+    def clearRAM(self):
+        for start, (end, alive) in self.ram_blocks.items():
+            alive[0] = False
+            self.ram_cache[start] = None
+        self.ram_blocks.clear()
+        for blocks in self.page_blocks:
+            blocks.clear()
+        self.block_map[:] = bytes(0x10000)
+
+    # returns the block at address, translating it on first use
+    # None if the code at address has to be interpreted
+    def lookup(self, address):
+        if address < 0x4000:
+            cache = self.rom_cache_low
+            index = address
+        elif address < 0x8000:
+            cache = self.rom_cache_high
+            index = address - 0x4000
+        elif 0xC000 <= address < 0xE000 or 0xFF80 <= address < 0xFFFF:
+            cache = self.ram_cache
+            index = address
+        else:
+            return None
+
+        block = cache[index]
+        if block is None:
+            block = self.translate(address)
+            cache[index] = block
+        if block is False:
+            return None
+        return block
+
+    # translates the block at address, False if its first instruction can't be translated
+    def translate(self, address):
+        if address < 0x4000:
+            end = 0x4000
+            alive = None
+        elif address < 0x8000:
+            end = 0x8000
+            alive = self.bank_alive[self.bank]
+        else:
+            end = 0xE000 if address < 0xE000 else 0xFFFF
+            alive = [True]
+
+        ops = []
+        pc = address
+        while len(ops) < MAX_BLOCK:
+            decoded = self.decoder.decode(pc)
+            # stay inside the region
+            if decoded >> 25 > end - pc:
+                break
+            instruction = self.decoder.instructions[(decoded >> 16) & 0x1FF]
+            next_pc = (pc + (decoded >> 25)) & 0xFFFF
+            op = self.translateInstruction(instruction, decoded & 0xFFFF, next_pc)
+            if op is None:
+                break
+            ops.append((instruction, op, next_pc))
+            pc = next_pc
+            if instruction.mnemonic in TERMINALS:
+                break
+        if ops:
+            source = self.generate(ops, alive is not None)
+            scope = {}
+            exec(compile(source, f"<block {address:04X}>", "exec"), scope)
+            memory = self.decoder.memory
+            block = scope["build"](self.cpu, self.cpu.registers, self.cpu.registers.r, memory.read8, memory.write8,
+                                   memory.read16, memory.write16, alive)
+            self.translated += 1
+        else:
+            # remembered until the bytes of the (at most 3 byte) instruction change
+            block = False
+            pc = min(address + 3, end)
+
+        if address >= 0x8000:
+            self.ram_blocks[address] = (pc, alive)
+            self.block_map[address:pc] = b"\x01" * (pc - address)
+            for page in range(address >> 8, ((pc - 1) >> 8) + 1):
+                self.page_blocks[page].add(address)
+        return block
+
+    # Code generation
+    def generate(self, ops, checked):
+        # flags are live at the end of the block and after writes that may exit early
+        live = 0xF0
+        needed = []
+        for instruction, op, next_pc in reversed(ops):
+            if checked and op.writes:
+                live = 0xF0
+            need = op.flag_writes & live != 0
+            needed.append(need)
+            live &= ~op.flag_writes
+            if need:
+                live |= op.flag_reads
+            live |= op.value_reads
+        needed.reverse()
+
+        body = []
+        elapsed = 0
+        synced = 0
+        for (instruction, op, next_pc), need in zip(ops, needed):
+            synced = self.emit(body, "", op.items, need, elapsed, synced)
+            if op.target is not None:
+                taken = elapsed + instruction.cycles[0]
+                if op.condition is None:
+                    body.append(("", f"return {taken}, {op.target}"))
+                else:
+                    body.append(("", f"if {op.condition}:"))
+                    self.emit(body, "    ", op.taken, True, elapsed, synced)
+                    body.append(("    ", f"return {taken}, {op.target}"))
+                    body.append(("", f"return {elapsed + instruction.cycles[-1]}, {next_pc}"))
+                break
+            elapsed += instruction.cycles[0]
+            if checked and op.writes:
+                # the write switched the bank or changed this block
+                body.append(("", "if not alive[0]:"))
+                body.append(("    ", f"return {elapsed}, {next_pc}"))
+        else:
+            body.append(("", f"return {elapsed}, {ops[-1][2]}"))
+
+        # load the registers used, store the ones written before every return
+        code = "\n".join(line for indent, line in body)
+        used = [name for name in LOCALS if re.search(rf"(?<![\w.]){name}(?!\w)", code)]
+        written = [name for name in LOCALS if re.search(rf"^\s*{name} [-+&|^]?= ", code, re.M)]
+        load = []
+        store = []
+        for name in used:
+            if name == "sp":
+                load.append("sp = regs.SP")
+            else:
+                load.append(f"{name} = slots[{SLOTS[name]}]")
+        for name in written:
+            if name == "sp":
+                store.append("regs.SP = sp")
+            else:
+                store.append(f"slots[{SLOTS[name]}] = {name}")
+
+        lines = ["def build(cpu, regs, slots, read, write, read16, write16, alive):", "    def block():"]
+        lines += ["        " + line for line in load]
+        for indent, line in body:
+            if line.startswith("return"):
+                lines += ["        " + indent + line for line in store]
+            lines.append("        " + indent + line)
+        lines.append("    return block")
+        return "\n".join(lines)
+
+    # appends the code of items to body, returns the cycles synced so far
+    @staticmethod
+    def emit(body, indent, items, need, elapsed, synced):
+        for item in items:
+            if isinstance(item, str):
+                body.append((indent, item))
+            elif item[0] == "sync":
+                # cycles into the block at the bus access, for the timer and screen to catch up to
+                pending = elapsed + item[1]
+                if pending != synced:
+                    body.append((indent, f"cpu.cycles = {pending}"))
+                synced = pending
+            elif need:
+                body.append((indent, item[1]))
+        return synced
+
+    # Translates one instruction, None if it has to be interpreted
+    def translateInstruction(self, instruction, value, next_pc):
+        mnemonic = instruction.mnemonic
+        operands = instruction.operands
+        names = [operand.name for operand in operands]
+        op = Op()
+
+        if mnemonic in ("NOP", "STOP"):
+            pass
+        elif mnemonic == "HALT":
+            op.line("cpu.halt = True")
+        elif mnemonic == "DI":
+            op.line("cpu.i_master = 0")
+        elif mnemonic == "EI":
+            op.line("cpu.i_master = 1")
+        elif mnemonic == "LD" or mnemonic == "LDH":
+            self.translateLoad(op, instruction, value)
+
+        elif mnemonic in ("INC", "DEC"):
+            name = names[0]
+            step = "+" if mnemonic == "INC" else "-"
+            if name in PAIRS or name == "SP":
+                if operands[0].immediate:
+                    setPair(op, name, f"{pair(name)} {step} 1")
+                    return op
+            if name in REGISTERS_8:
+                x = REGISTERS_8[name]
+                op.line(f"{x} = ({x} {step} 1) & 0xFF")
+            else:
+                x = "v"
+                op.line("p = h << 8 | l")
+                op.read("v", "p")
+                op.line(f"v = (v {step} 1) & 0xFF")
+            if mnemonic == "INC":
+                op.flags(f"f = f & 0x10 | ({x} == 0) << 7 | (({x} & 0xF) == 0) << 5", 0xE0, 0x10)
+            else:
+                op.flags(f"f = f & 0x10 | ({x} == 0) << 7 | 0x40 | (({x} & 0xF) == 0xF) << 5", 0xE0, 0x10)
+            if x == "v":
+                op.write("p", "v", 4)
+
+        elif mnemonic == "ADD" and names[0] == "HL":
+            op.line("u = h << 8 | l", f"w = {pair(names[1])}")
+            op.flags("f = f & 0x80 | ((u & 0xFFF) + (w & 0xFFF) > 0xFFF) << 5 | (u + w > 0xFFFF) << 4", 0x70, 0x80)
+            setPair(op, "HL", "u + w")
+        elif mnemonic == "ADD" and names[0] == "SP":
+            op.flags(f"f = ((sp & 0xF) + {value & 0xF} > 0xF) << 5 | ((sp & 0xFF) + {value} > 0xFF) << 4", 0xF0)
+            op.line(f"sp = (sp + {signed(value)}) & 0xFFFF")
+        elif mnemonic in ALU:
+            # the source is always the last operand
+            source = operands[-1]
+            if source.bytes is not None:
+                x = str(value)
+            elif source.name in REGISTERS_8:
+                x = REGISTERS_8[source.name]
+            else:
+                x = "v"
+                op.read("v", "h << 8 | l")
+            self.translateALU(op, mnemonic, x)
+
+        elif mnemonic in ROTATES_A:
+            shift = ROTATES_A[mnemonic]
+            op.line(SHIFTS[shift].format(x="a"))
+            if shift in ("RL", "RR"):
+                op.value_reads = 0x10
+            op.flags("f = (r > 0xFF) << 4", 0xF0)
+            op.line("a = r & 0xFF")
+        elif mnemonic == "DAA":
+            op.line("k = (0x06 if f & 0x20 else 0x00) | (0x60 if f & 0x10 else 0x00)",
+                    "if f & 0x40:",
+                    "    a -= k",
+                    "else:",
+                    "    k |= 0x06 if (a & 0x0F) > 0x09 else 0x00",
+                    "    k |= 0x60 if a > 0x99 else 0x00",
+                    "    a += k",
+                    "a &= 0xFF")
+            op.value_reads = 0x70
+            op.flags("f = f & 0x40 | (a == 0) << 7 | ((k & 0x60) != 0) << 4", 0xB0, 0x40)
+        elif mnemonic == "CPL":
+            op.line("a = ~a & 0xFF")
+            op.flags("f = f | 0x60", 0x60, 0x90)
+        elif mnemonic == "SCF":
+            op.flags("f = f & 0x80 | 0x10", 0x70, 0x80)
+        elif mnemonic == "CCF":
+            op.flags("f = f & 0x80 | (f & 0x10 ^ 0x10)", 0x70, 0x90)
+
+        elif mnemonic == "PUSH":
+            name = names[0]
+            hi, lo = PAIRS[name]
+            if name == "AF":
+                op.value_reads = 0xF0
+            op.line("sp = (sp - 2) & 0xFFFF")
+            op.write16("sp", f"{hi} << 8 | {lo}")
+        elif mnemonic == "POP":
+            name = names[0]
+            if name == "AF":
+                op.read16("t", "sp")
+                op.line("a = t >> 8", "f = t & 0xF0")
+                op.flag_writes = 0xF0
+            else:
+                hi, lo = PAIRS[name]
+                op.read16("t", "sp")
+                op.line(f"{hi} = t >> 8", f"{lo} = t & 0xFF")
+            op.line("sp = (sp + 2) & 0xFFFF")
+
+        elif mnemonic in SHIFTS or mnemonic in ("BIT", "RES", "SET"):
+            self.translateCB(op, instruction)
+        elif mnemonic in BRANCHES:
+            self.translateBranch(op, instruction, value, next_pc)
+        else:
+            # PREFIX and the illegal opcodes raise in the interpreter
+            return None
+        return op
+
+    def translateALU(self, op, mnemonic, x):
+        if mnemonic == "ADD":
+            op.line(f"r = a + {x}")
+            op.flags(f"f = ((r & 0xFF) == 0) << 7 | ((a & 0xF) + ({x} & 0xF) > 0xF) << 5 | (r > 0xFF) << 4", 0xF0)
+            op.line("a = r & 0xFF")
+        elif mnemonic == "ADC":
+            op.line("k = f >> 4 & 1", f"r = a + {x} + k")
+            op.value_reads = 0x10
+            op.flags(f"f = ((r & 0xFF) == 0) << 7 | ((a & 0xF) + ({x} & 0xF) + k > 0xF) << 5 | (r > 0xFF) << 4",
+                     0xF0)
+            op.line("a = r & 0xFF")
+        elif mnemonic == "SUB":
+            op.line(f"r = a - {x}")
+            op.flags(f"f = ((r & 0xFF) == 0) << 7 | 0x40 | ((a & 0xF) < ({x} & 0xF)) << 5 | (r < 0) << 4", 0xF0)
+            op.line("a = r & 0xFF")
+        elif mnemonic == "SBC":
+            op.line("k = f >> 4 & 1", f"r = a - {x} - k")
+            op.value_reads = 0x10
+            op.flags(f"f = ((r & 0xFF) == 0) << 7 | 0x40 | ((a & 0xF) - ({x} & 0xF) - k < 0) << 5 | (r < 0) << 4",
+                     0xF0)
+            op.line("a = r & 0xFF")
+        elif mnemonic == "AND":
+            op.line(f"a = a & {x}")
+            op.flags("f = (a == 0) << 7 | 0x20", 0xF0)
+        elif mnemonic == "XOR":
+            op.line(f"a = a ^ {x}")
+            op.flags("f = (a == 0) << 7", 0xF0)
+        elif mnemonic == "OR":
+            op.line(f"a = a | {x}")
+            op.flags("f = (a == 0) << 7", 0xF0)
+        else:
+            op.flags(f"f = (a == {x}) << 7 | 0x40 | ((a & 0xF) < ({x} & 0xF)) << 5 | (a < {x}) << 4", 0xF0)
+
+    def translateLoad(self, op, instruction, value):
+        operands = instruction.operands
+        dst, src = operands[0], operands[-1]
+
+        # LD HL,SP+r8
+        if len(operands) == 3:
+            op.flags(f"f = ((sp & 0xF) + {value & 0xF} > 0xF) << 5 | ((sp & 0xFF) + {value} > 0xFF) << 4", 0xF0)
+            setPair(op, "HL", f"sp + {signed(value)}")
+        # LD (a16),SP
+        elif dst.name == "a16" and src.name == "SP":
+            op.write16(str(value), "sp")
+        # (a8) and (a16) accesses, the bus access happens after the operand fetch
+        elif dst.name in ("a8", "a16"):
+            offset, fetch = (0xFF00, 4) if dst.name == "a8" else (0, 8)
+            op.write(str(value + offset), "a", fetch)
+        elif src.name in ("a8", "a16"):
+            offset, fetch = (0xFF00, 4) if src.name == "a8" else (0, 8)
+            op.read("a", str(value + offset), fetch)
+        # (C) accesses
+        elif dst.name == "C" and not dst.immediate:
+            op.write("c + 0xFF00", "a")
+        elif src.name == "C" and not src.immediate:
+            op.read("a", "c + 0xFF00")
+        # Immediate values
+        elif src.bytes is not None:
+            if not dst.immediate:
+                # LD (HL),d8
+                op.write("h << 8 | l", str(value), 4)
+            elif dst.name in REGISTERS_8:
+                op.line(f"{REGISTERS_8[dst.name]} = {value}")
+            else:
+                setPair(op, dst.name, str(value))
+        # Register pair pointers, with HL+/HL- adjust
+        elif not dst.immediate:
+            op.line(f"p = {pair(dst.name)}")
+            op.write("p", REGISTERS_8[src.name])
+            if dst.adjust is not None:
+                setPair(op, dst.name, f"p {dst.adjust} 1")
+        elif not src.immediate:
+            op.line(f"p = {pair(src.name)}")
+            op.read(REGISTERS_8[dst.name], "p")
+            if src.adjust is not None:
+                setPair(op, src.name, f"p {src.adjust} 1")
+        # Register to register
+        elif dst.name == "SP":
+            op.line("sp = h << 8 | l")
+        else:
+            op.line(f"{REGISTERS_8[dst.name]} = {REGISTERS_8[src.name]}")
+
+    def translateCB(self, op, instruction):
+        mnemonic = instruction.mnemonic
+        operands = instruction.operands
+        # target register, (HL) if not an 8 bit register
+        name = operands[-1].name
+        if name in REGISTERS_8:
+            x = REGISTERS_8[name]
+        else:
+            x = "v"
+            op.line("p = h << 8 | l")
+            op.read("v", "p", 4)
+
+        if mnemonic == "BIT":
+            mask = 1 << int(operands[0].name)
+            op.flags(f"f = f & 0x10 | (({x} & {mask}) == 0) << 7 | 0x20", 0xE0, 0x10)
+            return
+        if mnemonic == "RES":
+            result = f"{x} & {~(1 << int(operands[0].name)) & 0xFF}"
+        elif mnemonic == "SET":
+            result = f"{x} | {1 << int(operands[0].name)}"
+        else:
+            op.line(SHIFTS[mnemonic].format(x=x))
+            if mnemonic in ("RL", "RR"):
+                op.value_reads = 0x10
+            op.flags("f = ((r & 0xFF) == 0) << 7 | (r > 0xFF) << 4", 0xF0)
+            result = "r & 0xFF"
+        if x == "v":
+            op.write("p", result, 8)
+        else:
+            op.line(f"{x} = {result}")
+
+    def translateBranch(self, op, instruction, value, next_pc):
+        mnemonic = instruction.mnemonic
+        names = [operand.name for operand in instruction.operands]
+        # code run when the branch is taken
+        taken = Op()
+        if mnemonic in ("JP", "JR", "CALL", "RET") and names and names[0] in CONDITIONS:
+            op.condition, op.value_reads = CONDITIONS[names[0]]
+
+        if mnemonic == "JP":
+            op.target = "h << 8 | l" if names[-1] == "HL" else value
+        elif mnemonic == "JR":
+            op.target = (next_pc + signed(value)) & 0xFFFF
+        elif mnemonic in ("CALL", "RST"):
+            taken.line("sp = (sp - 2) & 0xFFFF")
+            taken.write16("sp", next_pc)
+            op.target = value if mnemonic == "CALL" else int(names[0][:-1], 16)
+        else:
+            if mnemonic == "RETI":
+                taken.line("cpu.i_master = True")
+            taken.read16("t", "sp")
+            taken.line("sp = (sp + 2) & 0xFFFF")
+            op.target = "t"
+
+        if op.condition is None:
+            op.items += taken.items
+        else:
+            op.taken = taken.items